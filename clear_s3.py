@@ -1,10 +1,16 @@
-from kvstore.s3 import delete_file, list_files
+import shutil
+
+from kvstore.s3 import S3Backend, delete_file, list_files
+from kvstore.wal import log_directory
 
 
 def main():
     for filename in list_files():
         delete_file(filename)
+    # the pairs logged for the bucket would be replayed into the empty bucket
+    directory = log_directory(S3Backend())
+    if directory is not None:
+        shutil.rmtree(directory, ignore_errors=True)
 
 if __name__ == '__main__':
     main()
-
@@ -5,7 +5,7 @@ from kvstore.s3 import *
 
 
 def main():
-    print(list(S3_BUCKET.objects.all()))
+    print(list_files())
     data = os.urandom(1024)
     print('uploading')
     print(upload_file('testkey', data))
@@ -28,7 +28,7 @@ def main():
         print('File was not found.')
     else:
         raise Exception('File should not have been found.')
-    print([o.key for o in S3_BUCKET.objects.all()])
+    print(list_files())
 
 if __name__ == '__main__':
     main()
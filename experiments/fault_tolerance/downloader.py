@@ -10,7 +10,7 @@ import sys
 import time
 
 from kvstore import get_item, initialize, store_database
-from kvstore.s3 import delete_file, list_files
+from kvstore.backend import delete_file, list_files
 from struct import unpack
 
 
@@ -10,7 +10,7 @@ import sys
 import time
 
 from kvstore import new_item, get_item, initialize, store_database, store_multi_item
-from kvstore.s3 import delete_file, list_files
+from kvstore.backend import delete_file, list_files
 
 
 def main():
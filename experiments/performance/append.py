@@ -0,0 +1,67 @@
+import argparse
+import os
+import queue
+import time
+
+from kvstore import new_item, initialize
+from kvstore.backend import MemoryBackend
+from kvstore.config import config, SealPolicy
+from kvstore.item import SEAL_QUEUE
+
+# you can run this code using 'python experiments/performance/append.py'
+# or 'python3 experiments/performance/append.py'
+
+# throughput of new_item while filling multi-items of 10 to 100k sub-items of
+# 128B. The multi-items are sealed once full but never uploaded, and the
+# write-ahead log is disabled, so only the cost of appending to a multi-item is
+# measured. No S3 access is needed.
+# the time per key should not grow with the size of the multi-item.
+
+COUNTS = [10, 100, 1000, 10000, 100000]
+VALUE_SIZE = 128
+
+
+def drain_sealed():
+    """Drop the sealed multi-items instead of uploading them."""
+    while True:
+        try:
+            SEAL_QUEUE.get_nowait()
+        except queue.Empty:
+            break
+        SEAL_QUEUE.task_done()
+
+
+def measure(count, multi_items, value):
+    """Measure the time to fill multi_items multi-items of count sub-items."""
+    config.SEAL_POLICY = SealPolicy(max_items=count, max_bytes=2 ** 40,
+                                    max_age=0)
+    start_time = time.perf_counter()
+    for m in range(multi_items):
+        for x in range(count):
+            new_item('item-' + str(count) + '-' + str(m) + '-' + str(x),
+                     value, sync=False)
+        drain_sealed()
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--counts', type=int, nargs='+', default=COUNTS,
+                        help='sub-items per multi-item')
+    parser.add_argument('--keys', type=int, default=100000,
+                        help='keys to append for every multi-item size')
+    args = parser.parse_args()
+
+    config.WAL_DIRECTORY = None
+    initialize(fetch=False, backend=MemoryBackend(), watch=False)
+    value = os.urandom(VALUE_SIZE)
+
+    print ("{:<10} {:<10} {:<12} {:<14} {:<12}".format('pairs','keys','time (sec)','keys per sec','usec per key'))
+    for count in args.counts:
+        multi_items = max(1, args.keys // count)
+        duration = measure(count, multi_items, value)
+        keys = multi_items * count
+        print ("{:<10} {:<10} {:<12} {:<14} {:<12}".format(count, keys, '{:.3f}'.format(duration), '{:.0f}'.format(keys / duration), '{:.2f}'.format(duration / keys * 10 ** 6)))
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,37 @@
+import argparse
 import os
 import time
-import boto3
-from botocore.client import Config
+
+from kvstore.backend import create_backend, set_backend, upload_file
 
 # you can run this code using 'python experiments/performance/benchmark.py' 
 # or 'python3 experiments/performance/benchmark.py'
 
-# We have removed all the sensitive information from our code, 
-# so everyone who is intereseted can simlpy use their own creditials info
-
-ACCESS_KEY_ID = '' 
-ACCESS_SECRET_KEY = ''
-BUCKET_NAME = ''
-
-# Connection to S3 Service
-s3 = boto3.resource(
-    's3',
-    aws_access_key_id=ACCESS_KEY_ID,
-    aws_secret_access_key=ACCESS_SECRET_KEY,
-    config=Config(signature_version='s3v4')
-)
-
-# first file usually has higher latency compared to following ones
-s3.Bucket(BUCKET_NAME).put_object(Key='benchmark/test_file', Body=os.urandom(32))
+# The S3 credentials are configured in kvstore/s3.py. Use '--backend memory' or
+# '--backend local --directory DIR' to run the benchmark without credentials.
 
 def upload(data, size, i):
     upload_time_total = 0
     for x in range(i): 
         start_time = time.time()
-        s3.Bucket(BUCKET_NAME).put_object(Key='benchmark/'+str(size)+'file', Body=data)
+        upload_file('benchmark-'+str(size)+'file', data)
         upload_time = time.time() - start_time
         upload_time_total += upload_time
     return upload_time_total
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=('s3', 'local', 'memory'),
+                        default='s3')
+    parser.add_argument('--directory', default='kvstore_data',
+                        help='directory for the local backend')
+    args = parser.parse_args()
+    kwargs = {'directory': args.directory} if args.backend == 'local' else {}
+    set_backend(create_backend(args.backend, **kwargs))
+
+    # first file usually has higher latency compared to following ones
+    upload_file('benchmark-test_file', os.urandom(32))
+
     print ("{:<8} {:<20} {:<20} {:<20} {:<20} {:<20} {:<20}".format('time','1pair','5pairs','10pairs','25pairs','50pairs','100pairs'))
     for x in range(6): 
         size = 32 * (2 ** x)
@@ -0,0 +1,87 @@
+import argparse
+import json
+import random
+import time
+
+from kvstore.codec import CODECS, choose_codec, compress, decompress
+from kvstore.zdict import train, compress_value
+
+# you can run this code using 'python experiments/performance/compression.py'
+# or 'python3 experiments/performance/compression.py'
+
+# bytes saved and cpu time spent by each codec on the values of a multi-item,
+# for values of 32B to 1024B, the same value sizes as in latency.py. The values
+# are json records of random words, like the values the store is used for. No
+# S3 access is needed.
+# zdict compresses every value on its own with a dictionary trained on other
+# values of the same size, which keeps single values downloadable on their own.
+
+WORDS = ['key', 'value', 'store', 'item', 'multi', 'bucket', 'upload', 'latency',
+         'database', 'journal', 'request', 'object', 'sensor', 'user', 'event']
+
+
+def create_value(size, rng):
+    """Create a json value of exactly size bytes."""
+    record = {'id': rng.randrange(10 ** 6), 'type': rng.choice(WORDS),
+              'text': ''}
+    text = []
+    while len(json.dumps(record)) < size:
+        text.append(rng.choice(WORDS))
+        record['text'] = ' '.join(text)
+    return bytes(json.dumps(record), 'utf8')[:size]
+
+
+def measure(codec, data, repeat):
+    """Measure the compressed size and the cpu time to (de)compress."""
+    best_compress, best_decompress = None, None
+    for _ in range(repeat):
+        start_time = time.process_time()
+        compressed = compress(codec, data)
+        duration = time.process_time() - start_time
+        best_compress = duration if best_compress is None else min(best_compress, duration)
+        start_time = time.process_time()
+        decompress(codec, compressed)
+        duration = time.process_time() - start_time
+        best_decompress = duration if best_decompress is None else min(best_decompress, duration)
+    return len(compressed), best_compress, best_decompress
+
+
+def measure_zdict(zdict, values, repeat):
+    """Measure the size and the cpu time to compress every value on its own."""
+    best = None
+    for _ in range(repeat):
+        start_time = time.process_time()
+        stored = sum(len(compress_value(zdict, value)) for value in values)
+        duration = time.process_time() - start_time
+        best = duration if best is None else min(best, duration)
+    return stored, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, nargs='+', default=[3, 100, 1000],
+                        help='sub-items per multi-item')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    rng = random.Random(0)
+
+    print ("{:<8} {:<8} {:<8} {:<12} {:<12} {:<10} {:<16} {:<16}".format('pairs','size','codec','raw','stored','saved','compress (sec)','decompress (sec)'))
+    for count in args.items:
+        for x in range(6):
+            size = 32 * (2 ** x)
+            values = [create_value(size, rng) for _ in range(count)]
+            data = b''.join(values)
+            for name, codec in CODECS.items():
+                stored, compress_time, decompress_time = measure(codec, data, args.repeat)
+                print ("{:<8} {:<8} {:<8} {:<12} {:<12} {:<10} {:<16} {:<16}".format(count, size, name, len(data), stored, '{:.1%}'.format(1 - stored / len(data)), '{:.6f}'.format(compress_time), '{:.6f}'.format(decompress_time)))
+            zdict = train([create_value(size, rng) for _ in range(200)])
+            stored, compress_time = measure_zdict(zdict, values, args.repeat)
+            print ("{:<8} {:<8} {:<8} {:<12} {:<12} {:<10} {:<16} {:<16}".format(count, size, 'zdict', len(data), stored, '{:.1%}'.format(1 - stored / len(data)), '{:.6f}'.format(compress_time), ''))
+            start_time = time.process_time()
+            codec = choose_codec('auto', data, 0.1)
+            duration = time.process_time() - start_time
+            name = {c: n for n, c in CODECS.items()}.get(codec, 'none')
+            print ("{:<8} {:<8} {:<8} {:<12} {:<12} {:<10} {:<16} {:<16}".format(count, size, 'auto', len(data), name, '', '{:.6f}'.format(duration), ''))
+
+if __name__ == '__main__':
+    main()
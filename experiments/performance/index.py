@@ -0,0 +1,96 @@
+import argparse
+import pickle
+import random
+import string
+import time
+
+from kvstore.index import ItemType, decode_index, encode_index
+
+# you can run this code using 'python experiments/performance/index.py'
+# or 'python3 experiments/performance/index.py'
+
+# size of the stored index and time to load it, for the pickled dict of dicts
+# of older versions and the columnar encoding of kvstore.index. No S3 access is
+# needed, the index is built in memory like after storing the given number of
+# keys in multi-items of MAX_MULTI_ITEM_SIZE sub-items. Loading is followed by
+# looking up random keys, since the columnar index decodes entries on lookup.
+# 10M keys need several GB of memory for the dict of dicts.
+
+MAX_MULTI_ITEM_SIZE = 3
+VALUE_SIZE = 128
+
+
+def random_key(rng, length=10):
+    return ''.join(rng.choice(string.ascii_lowercase + string.digits)
+                   for _ in range(length))
+
+
+def create_database(count, rng):
+    """Create the database of count keys in stored multi-items."""
+    items = {}
+    nums = {}
+    for num in range(1, count // MAX_MULTI_ITEM_SIZE + 2):
+        multi_key = random_key(rng)
+        subs = [random_key(rng, 16) for _ in range(MAX_MULTI_ITEM_SIZE)]
+        for i, key in enumerate(subs):
+            items[key] = {'type': ItemType.SUB, 'part-of': multi_key,
+                          'offset': 100 + i * VALUE_SIZE, 'length': VALUE_SIZE}
+        items[multi_key] = {'type': ItemType.MULTI, 'num': num,
+                            'bytes': VALUE_SIZE * len(subs),
+                            'live': VALUE_SIZE * len(subs)}
+        nums[num] = multi_key
+    return {'items': items, 'nums': nums, 'current_num': len(nums)}
+
+
+def lookup(database, keys):
+    """Look up every key, as get_item does."""
+    for key in keys:
+        if key in database['items']:
+            database['items'][key]['type']
+
+
+def measure(dump, load, database, keys, repeat):
+    """Measure the dumped size and the time to dump, load and look up."""
+    start_time = time.perf_counter()
+    data = dump(database)
+    dump_time = time.perf_counter() - start_time
+    best_load, best_lookup = None, None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        loaded = load(data)
+        duration = time.perf_counter() - start_time
+        best_load = duration if best_load is None else min(best_load, duration)
+        start_time = time.perf_counter()
+        lookup(loaded, keys)
+        duration = time.perf_counter() - start_time
+        best_lookup = duration if best_lookup is None else min(best_lookup, duration)
+        del loaded
+    return len(data), dump_time, best_load, best_lookup
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, nargs='+',
+                        default=[10 ** 4, 10 ** 6, 10 ** 7])
+    parser.add_argument('--lookups', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    rng = random.Random(0)
+
+    encodings = {
+        'pickle': (lambda database: pickle.dumps(database), pickle.loads),
+        'columns': (lambda database: encode_index(database, 0),
+                    lambda data: decode_index(data)[0])
+    }
+    print ("{:<10} {:<8} {:<14} {:<12} {:<12} {:<14}".format('keys','index','size','dump (sec)','load (sec)','lookups (sec)'))
+    for count in args.keys:
+        database = create_database(count, rng)
+        keys = rng.sample(list(database['items']), min(args.lookups, len(database['items'])))
+        keys += [random_key(rng, 16) for _ in range(len(keys) // 10)]
+        for name, (dump, load) in encodings.items():
+            size, dump_time, load_time, lookup_time = measure(dump, load, database, keys, args.repeat)
+            print ("{:<10} {:<8} {:<14} {:<12} {:<12} {:<14}".format(count, name, size, '{:.3f}'.format(dump_time), '{:.3f}'.format(load_time), '{:.3f}'.format(lookup_time)))
+        del database
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,17 @@
+import argparse
 import os
 import time
-from botocore.client import Config
 
 from kvstore import new_item, initialize, store_multi_item, store_database
-from kvstore.s3 import delete_file, list_files
+from kvstore.backend import create_backend, delete_file, list_files
+from kvstore.wal import write_ahead_log
 
 # you can run this code using 'python experiments/performance/latency.py' 
 # or 'python3 experiments/performance/latency.py'
 
+# use '--backend memory' or '--backend local --directory DIR' to measure the
+# overhead of the kv store itself, without network time or S3 credentials.
+
 # watcher should be switched off for that experiment
 
 # uploading latency of 32B, 64B, 128B, 256B, 512B, 1024B kv-pairs to s3:
@@ -16,6 +20,11 @@ from kvstore.s3 import delete_file, list_files
 def clear_bucket():
     for filename in list_files():
         delete_file(filename)
+    # the local write-ahead log of the deleted objects would be replayed
+    log = write_ahead_log()
+    if log is not None:
+        for filename, _ in log.segments():
+            log.delete(filename)
 
 def upload(value, size, i):
     start_time = time.time()
@@ -33,6 +42,15 @@ def upload(value, size, i):
     return upload_time
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=('s3', 'local', 'memory'),
+                        default='s3')
+    parser.add_argument('--directory', default='kvstore_data',
+                        help='directory for the local backend')
+    args = parser.parse_args()
+    kwargs = {'directory': args.directory} if args.backend == 'local' else {}
+    initialize(backend=create_backend(args.backend, **kwargs))
+
     print ("{:<8} {:<20} {:<20} {:<20} {:<20} {:<20} {:<20}".format('time','1pair','5pairs','10pairs','25pairs','50pairs','100pairs'))
     
     for x in range(6): 
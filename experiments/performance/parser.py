@@ -0,0 +1,77 @@
+import argparse
+import os
+import time
+
+from kvstore.item import SubItem, load_data
+
+# you can run this code using 'python experiments/performance/parser.py'
+# or 'python3 experiments/performance/parser.py'
+
+# parsing time of multi-items with 10 to 100k sub-items of 32B to 1024B, the
+# same value sizes as in latency.py. No S3 access is needed.
+# the old parser copies the remaining raw data for every sub-item, so it is only
+# run for multi-items up to --legacy-limit bytes.
+
+COUNTS = [10, 100, 1000, 10000, 100000]
+
+
+def create_rawdata(count, size):
+    """Create the raw data of a multi-item, see MultiItem._write_item."""
+    keys = [bytes('item-' + str(size) + '-' + str(x), 'utf8')
+            for x in range(count)]
+    header = [b'm', b'benchmark', bytes(str(count), 'utf8')]
+    for key in keys:
+        header += [key, bytes(str(size), 'utf8')]
+    value = os.urandom(size)
+    return b'\0'.join(header) + b'\0' + value * count
+
+
+def legacy_parse(rawdata):
+    """The original parser of MultiItem._read_item, kept for comparison."""
+    _, _, rawdata = rawdata.split(b'\0', 2)
+    log = []
+    items = {}
+    num_items, rawdata = rawdata.split(b'\0', 1)
+    for _ in range(int(num_items)):
+        key, rawdata = rawdata.split(b'\0', 1)
+        length, rawdata = rawdata.split(b'\0', 1)
+        log.append((str(key, 'utf8'), int(length)))
+    for key, length in log:
+        value, rawdata = rawdata[:length], rawdata[length:]
+        items[key] = SubItem(key, value, is_uploaded=True, reloaded=True)
+    return items
+
+
+def measure(function, rawdata, repeat):
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function(rawdata)
+        duration = time.perf_counter() - start_time
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--legacy-limit', type=int, default=2 ** 20,
+                        help='largest multi-item in bytes for the old parser')
+    args = parser.parse_args()
+
+    print ("{:<8} {:<8} {:<12} {:<20} {:<20} {:<10}".format('pairs','size','bytes','old (sec)','new (sec)','speedup'))
+    for count in COUNTS:
+        for x in range(6):
+            size = 32 * (2 ** x)
+            rawdata = create_rawdata(count, size)
+            new = measure(lambda d: load_data(d, reloaded=True), rawdata, args.repeat)
+            if len(rawdata) <= args.legacy_limit:
+                old = measure(legacy_parse, rawdata, args.repeat)
+                speedup = '{:.1f}x'.format(old / new)
+                old = '{:.6f}'.format(old)
+            else:
+                old, speedup = '-', '-'
+            print ("{:<8} {:<8} {:<12} {:<20} {:<20} {:<10}".format(count, size, len(rawdata), old, '{:.6f}'.format(new), speedup))
+
+if __name__ == '__main__':
+    main()
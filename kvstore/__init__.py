@@ -1,48 +1,136 @@
-from kvstore.config import config
-from kvstore.database import get_item, load_database, store_database, database, \
+import typing
+
+from kvstore.backend import Backend, set_backend
+from kvstore.config import config, SealPolicy
+from kvstore.database import get_item, get_items, load_database, store_database, store_journal, database, \
     database_set_loader
-from kvstore.item import new_multi_item, download_missing, load_data, SubItem
+from kvstore.item import new_multi_item, download_missing, load_data, load_sub_data, SubItem, \
+    SEAL_LOCK, replay_log, append_items
+from kvstore.wal import sync_log
+from kvstore.zdict import load_dictionaries
 from kvstore.watcher import watcher, swap_multi_item
 
-__all__ = ('new_item', 'get_value')
+__all__ = ('new_item', 'put', 'put_many', 'get_value', 'get_many')
 
 
-def initialize(fetch=True, dbg=False):
+def initialize(fetch=True, dbg=False, backend: Backend = None, watch=True,
+               policy: SealPolicy = None, compression: str = None):
     """Initialize the KV store.
 
     This function should be called before any others.
+
+    Args:
+        fetch (bool): Download the stored items missing in the database.
+        dbg (bool): Print the database after every step.
+        backend (Backend): The storage backend to use. Default is the
+            previously set backend, or S3 if none was set.
+        watch (bool): Start the watcher threads storing multi-items and the
+            database in the background.
+        policy (SealPolicy): The policy deciding when multi-items are sealed.
+            Default is the policy in the configuration.
+        compression (str): The codec to compress multi-items with, either
+            `zlib`, `lzma`, `bz2`, `auto` to choose by compression ratio, or
+            `zdict` to compress every value with a trained dictionary, see
+            `kvstore.zdict.train_dictionary`. Default is the codec in the
+            configuration.
     """
     def dump():
         if dbg: print('db:', database())
 
+    if backend is not None:
+        set_backend(backend)
+    if policy is not None:
+        config.SEAL_POLICY = policy
+    if compression is not None:
+        config.COMPRESSION = compression
     dump()
     load_database()
+    load_dictionaries()
 
-    database_set_loader(load_data)
+    database_set_loader(load_data, load_sub_data)
     dump()
 
     if fetch: download_missing()
     dump()
 
-    watcher()
+    replay_log()
+    dump()
+
+    if watch: watcher()
 
 
-def new_item(key: str, value: bytes) -> SubItem:
+def new_item(key: str, value: bytes, sync: bool = True,
+             overwrite: bool = False) -> SubItem:
     """Create a new key-value item in the current multi-item.
 
+    The key-value pair is written to the local write-ahead log, so it survives
+    a crash of the process. The item is stored in the background. Use `wait()`
+    or `persisted` of the returned sub-item to wait until it is stored,
+    together with all other items in the same multi-item.
+
     Args:
         key (str): The key.
         value (bytes): The value.
+        sync (bool): Wait until the write-ahead log is synced to disk. The
+            writers appending at the same time share a single sync.
+        overwrite (bool): Allow the key to exist already, see `put`.
 
     Returns:
         SubItem: The created sub-item.
     """
-    multi_item = config.CURRENT_MULTI_ITEM
-    if multi_item is None:
-        config.CURRENT_MULTI_ITEM = new_multi_item()
-        return new_item(key, value)
-    multi_item.append_key_value(key, value)
-    return get_item(key)
+    # the multi-item cannot be sealed by another thread while appending to it
+    with SEAL_LOCK:
+        multi_item = config.CURRENT_MULTI_ITEM
+        if multi_item is None:
+            config.CURRENT_MULTI_ITEM = new_multi_item()
+            return new_item(key, value, sync, overwrite)
+        item = multi_item.append_key_value(key, value, overwrite)
+    # sync outside of the lock, so concurrent writers can share the sync
+    if sync: sync_log()
+    return item
+
+
+def put(key: str, value: bytes, sync: bool = True) -> SubItem:
+    """Set the value for a key, whether it exists or not.
+
+    The new version is appended to the current multi-item like a new item, and
+    the key points to the newest version from then on. Older versions are left
+    in their multi-items until these are compacted.
+
+    Args:
+        key (str): The key.
+        value (bytes): The value.
+        sync (bool): Wait until the write-ahead log is synced to disk.
+
+    Returns:
+        SubItem: The created sub-item.
+    """
+    return new_item(key, value, sync, overwrite=True)
+
+
+def put_many(mapping: typing.Mapping[str, bytes],
+             sync: bool = True) -> typing.List[SubItem]:
+    """Set the values for many keys at once, see `put`.
+
+    All keys are checked before the batch is appended to the current
+    multi-item under a single lock, so either all or none of the pairs are
+    written. Multi-items that fill up along the way are sealed at the size of
+    the seal policy, and the rest of the batch goes to the next one. The whole
+    batch shares a single sync of the write-ahead log.
+
+    Args:
+        mapping (dict of str to bytes): The values by their keys.
+        sync (bool): Wait until the write-ahead log is synced to disk.
+
+    Returns:
+        list of SubItem: The created sub-items.
+
+    Raises:
+        ValueError: If a key exists and is not a sub-item.
+    """
+    items = append_items(mapping.items(), overwrite=True)
+    if sync: sync_log()
+    return items
 
 
 def get_value(key: str) -> SubItem:
@@ -57,6 +145,21 @@ def get_value(key: str) -> SubItem:
     return get_item(key)
 
 
+def get_many(keys: typing.Iterable[str]) -> typing.Dict[str, SubItem]:
+    """Get the sub-items for many keys at once.
+
+    The keys are grouped by the object they are stored in, and every object
+    is downloaded only once, concurrently with the others.
+
+    Args:
+        keys (iterable of str): The keys to get the sub-items for.
+
+    Returns:
+        dict of str to SubItem: The retrieved sub-items by their keys.
+    """
+    return get_items(keys)
+
+
 def store_multi_item():
     """Create a new multi item and swap with the old one."""
     swap_multi_item()
@@ -0,0 +1,221 @@
+"""Asyncio interface to the key-value store.
+
+Example:
+    async with AsyncStore(backend=MemoryBackend()) as store:
+        await store.put('key', b'value')
+        await store.flush()
+        value = await store.get('key')
+"""
+import asyncio
+import concurrent.futures
+import queue
+import typing
+
+from kvstore import initialize, new_item, put_many
+from kvstore.backend import Backend
+from kvstore.compaction import RateLimiter, compact, merge
+from kvstore.config import config, SealPolicy
+from kvstore.database import get_item, get_items, references, \
+    store_changes, store_journal
+from kvstore.item import SEAL_QUEUE, seal_multi_item
+from kvstore.wal import sync_log
+from kvstore.watcher import upload_multi_item
+
+
+class AsyncStore:
+    """The key-value store for use from an asyncio event loop.
+
+    All blocking storage requests run in a thread pool, so many requests can be
+    in flight at once without blocking the event loop. Writes run there as
+    well, since checking if a key exists may download a shard of the index. Instead of the watcher
+    threads, sealing multi-items, storing the database and compaction run as
+    tasks on the event loop.
+
+    Args:
+        backend (Backend): The storage backend to use. Default is the
+            previously set backend, or S3 if none was set.
+        fetch (bool): Download the stored items missing in the database when
+            opening the store.
+        max_workers (int): The maximum number of storage requests in flight.
+        policy (SealPolicy): The policy deciding when multi-items are sealed.
+            Default is the policy in the configuration.
+        compression (str): The codec to compress multi-items with. Default is
+            the codec in the configuration.
+    """
+
+    def __init__(self, backend: Backend = None, fetch: bool = True,
+                 max_workers: int = 16, policy: SealPolicy = None,
+                 compression: str = None):
+        self._backend = backend
+        self._fetch = fetch
+        self._policy = policy
+        self._compression = compression
+        self._wakeup = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._uploads = set()
+        self._tasks = []
+
+    async def __aenter__(self) -> 'AsyncStore':
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _run(self, function, *args):
+        """Run a blocking function in the thread pool."""
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._executor, function, *args)
+
+    async def open(self):
+        """Initialize the store and start the background tasks."""
+        await self._run(lambda: initialize(fetch=self._fetch,
+                                           backend=self._backend,
+                                           watch=False,
+                                           policy=self._policy,
+                                           compression=self._compression))
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._seal_loop()),
+                       asyncio.create_task(self._database_loop()),
+                       asyncio.create_task(self._compaction_loop())]
+
+    async def close(self):
+        """Store everything that is pending and stop the background tasks."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+        self._executor.shutdown()
+
+    async def get(self, key: str) -> bytes:
+        """Get the value for a certain key.
+
+        Args:
+            key (str): The key to get the value for.
+
+        Returns:
+            bytes: The value.
+        """
+        item = references().get(key)
+        if item is None:
+            item = await self._run(get_item, key)
+        return item.value
+
+    async def put(self, key: str, value: bytes, durable: bool = False):
+        """Set the value for a key in the current multi-item.
+
+        An existing key is overwritten, see `kvstore.put`. The key-value pair
+        is appended and synced to the write-ahead log in the thread pool. Once the
+        multi-item is full according to the seal policy, it is sealed and
+        uploaded in the background.
+
+        Args:
+            key (str): The key.
+            value (bytes): The value.
+            durable (bool): Wait until the item is uploaded and registered in
+                the stored database, together with the other items in its
+                multi-item.
+
+        Returns:
+            SubItem: The created sub-item.
+        """
+        item = await self._run(lambda: new_item(key, value, sync=False,
+                                                overwrite=True))
+        self._upload_sealed()
+        self._wakeup.set()
+        await self._run(sync_log)
+        if durable:
+            await asyncio.wrap_future(item.persisted)
+        return item
+
+    async def get_many(self, keys: typing.Iterable[str]
+                       ) -> typing.Dict[str, bytes]:
+        """Get the values for many keys, see `kvstore.get_many`.
+
+        Args:
+            keys (iterable of str): The keys to get the values for.
+
+        Returns:
+            dict of str to bytes: The values by their keys.
+        """
+        keys = list(keys)
+        cached = references()
+        items = {key: cached.get(key) for key in keys}
+        missing = [key for key, item in items.items() if item is None]
+        if missing:
+            items.update(await self._run(get_items, missing))
+        return {key: item.value for key, item in items.items()}
+
+    async def put_many(self, mapping: typing.Mapping[str, bytes],
+                       durable: bool = False):
+        """Set the values for many keys at once, see `kvstore.put_many`.
+
+        Args:
+            mapping (dict of str to bytes): The values by their keys.
+            durable (bool): Wait until all items are uploaded and registered
+                in the stored database.
+
+        Returns:
+            list of SubItem: The created sub-items.
+        """
+        items = await self._run(lambda: put_many(mapping, sync=False))
+        self._upload_sealed()
+        self._wakeup.set()
+        await self._run(sync_log)
+        if durable:
+            persisted = {id(item.persisted): item.persisted for item in items}
+            await asyncio.gather(*(asyncio.wrap_future(future)
+                                   for future in persisted.values()))
+        return items
+
+    async def flush(self):
+        """Upload the current multi-item and the changes to the database."""
+        await self._run(seal_multi_item)
+        self._upload_sealed()
+        if self._uploads:
+            await asyncio.gather(*self._uploads)
+        await self._run(store_journal)
+
+    def _upload_sealed(self):
+        """Upload the sealed multi-items in background tasks."""
+        while True:
+            try:
+                multi_item = SEAL_QUEUE.get_nowait()
+            except queue.Empty:
+                break
+            if multi_item is None:
+                SEAL_QUEUE.task_done()
+                continue
+            upload = asyncio.ensure_future(
+                self._run(upload_multi_item, multi_item))
+            self._uploads.add(upload)
+            upload.add_done_callback(self._uploads.discard)
+
+    async def _seal_loop(self):
+        """Seal the current multi-item once it hits the age limit."""
+        while True:
+            self._wakeup.clear()
+            remaining = config.SEAL_POLICY.remaining(config.CURRENT_MULTI_ITEM)
+            if remaining is None:
+                await self._wakeup.wait()
+                continue
+            await asyncio.sleep(remaining)
+            if config.SEAL_POLICY.is_expired(config.CURRENT_MULTI_ITEM):
+                await self._run(seal_multi_item)
+                self._upload_sealed()
+
+    async def _database_loop(self):
+        """Periodically upload a journal delta and store checkpoints."""
+        changes = None
+        while True:
+            await asyncio.sleep(config.DATABASE_DUMP_INTERVAL_ONLINE)
+            changes = await self._run(store_changes, changes)
+
+    async def _compaction_loop(self):
+        """Periodically compact and merge the stored multi-items."""
+        limiter = RateLimiter(config.COMPACTION_RATE)
+        while config.COMPACTION_INTERVAL:
+            await asyncio.sleep(config.COMPACTION_INTERVAL)
+            await self._run(compact, None, limiter)
+            await self._run(merge, None, limiter)
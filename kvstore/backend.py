@@ -0,0 +1,321 @@
+import hashlib
+import os
+import threading
+import typing
+
+from kvstore.cache import disk_cache
+from kvstore.exceptions import StorageFileNotFoundError
+
+
+class Storage:
+    """Stores the reference to the storage backend in use."""
+    BACKEND = None
+
+
+class Backend:
+    """The interface every storage backend implements.
+
+    The key-value store only ever stores whole files under a flat filename, so
+    a backend only needs to be able to upload, download, delete and list
+    files.
+    """
+
+    @property
+    def name(self) -> typing.Optional[str]:
+        """str or None: A name for the place the files are stored, e.g. the
+        bucket.
+
+        Local state belonging to the stored files, like the write-ahead log,
+        is kept apart per name. None if the files do not outlive the process,
+        in which case no such state is kept.
+        """
+        return None
+
+    def upload_file(self, filename: str, data: bytes):
+        """Upload a file, overwriting any existing file with the same name.
+
+        Args:
+            filename (str): The filename to upload under.
+            data (bytes or bytearray): The content of the file. The buffer is
+                uploaded as is, without wrapping it in a file object.
+        """
+        raise NotImplementedError()
+
+    def download_file(self, filename: str) -> bytes:
+        """Download a file.
+
+        Args:
+            filename (str): The filename to download.
+
+        Returns:
+            bytes: The contents of the file.
+
+        Raises:
+            StorageFileNotFoundError: If the file does not exist.
+        """
+        raise NotImplementedError()
+
+    def download_range(self, filename: str, offset: int, length: int) -> bytes:
+        """Download a part of a file.
+
+        By default, the whole file is downloaded and sliced. Backends that can
+        read a part of a file directly should override this.
+
+        Args:
+            filename (str): The filename to download from.
+            offset (int): The offset of the first byte to download.
+            length (int): The number of bytes to download.
+
+        Returns:
+            bytes: The requested part of the file.
+        """
+        return self.download_file(filename)[offset:offset + length]
+
+    def delete_file(self, filename: str) -> bool:
+        """Delete a file.
+
+        Args:
+            filename (str): The filename to delete.
+
+        Returns:
+            bool: True if deletion was succesful.
+        """
+        raise NotImplementedError()
+
+    def delete_files(self, filenames: typing.List[str]) -> bool:
+        """Delete several files at once.
+
+        By default, the files are deleted one by one. Backends that can delete
+        many files in a single request should override this.
+
+        Args:
+            filenames (list of str): The filenames to delete.
+
+        Returns:
+            bool: True if deletion was succesful.
+        """
+        for filename in filenames:
+            self.delete_file(filename)
+        return True
+
+    def list_files(self, prefix: str = '') -> typing.List[str]:
+        """List the stored files.
+
+        Args:
+            prefix (str): Only list the files starting with this prefix.
+
+        Returns:
+            list of str: The filenames of all stored files.
+        """
+        raise NotImplementedError()
+
+
+class MemoryBackend(Backend):
+    """A backend keeping all files in a dictionary in memory.
+
+    Nothing survives the process, so this is only useful to measure the
+    overhead of the key-value store itself.
+    """
+
+    def __init__(self):
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def upload_file(self, filename: str, data: bytes):
+        with self._lock:
+            self._files[filename] = bytes(data)
+
+    def download_file(self, filename: str) -> bytes:
+        with self._lock:
+            if filename not in self._files:
+                raise StorageFileNotFoundError(
+                    'File {} not found.'.format(filename))
+            return self._files[filename]
+
+    def download_range(self, filename: str, offset: int, length: int) -> bytes:
+        return self.download_file(filename)[offset:offset + length]
+
+    def delete_file(self, filename: str) -> bool:
+        with self._lock:
+            self._files.pop(filename, None)
+        return True
+
+    def list_files(self, prefix: str = '') -> typing.List[str]:
+        with self._lock:
+            return [name for name in self._files if name.startswith(prefix)]
+
+
+class LocalBackend(Backend):
+    """A backend storing every file in a local directory.
+
+    Args:
+        directory (str): The directory to store the files in. It is created if
+            it does not exist yet.
+    """
+
+    def __init__(self, directory: str):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def name(self) -> str:
+        path = os.path.abspath(self._directory)
+        digest = hashlib.sha1(bytes(path, 'utf8')).hexdigest()[:8]
+        return 'local-{}-{}'.format(os.path.basename(path), digest)
+
+    def _path(self, filename: str) -> str:
+        """Get the path of a file in the directory."""
+        if os.sep in filename or filename in ('', '.', '..'):
+            raise ValueError('Invalid filename {}.'.format(filename))
+        return os.path.join(self._directory, filename)
+
+    def upload_file(self, filename: str, data: bytes):
+        path = self._path(filename)
+        # write to a temporary file first, so a file is replaced atomically
+        # just like an object on S3.
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def download_file(self, filename: str) -> bytes:
+        try:
+            with open(self._path(filename), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise StorageFileNotFoundError(
+                'File {} not found.'.format(filename))
+
+    def download_range(self, filename: str, offset: int, length: int) -> bytes:
+        try:
+            with open(self._path(filename), 'rb') as f:
+                f.seek(offset)
+                return f.read(length)
+        except FileNotFoundError:
+            raise StorageFileNotFoundError(
+                'File {} not found.'.format(filename))
+
+    def delete_file(self, filename: str) -> bool:
+        try:
+            os.remove(self._path(filename))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def list_files(self, prefix: str = '') -> typing.List[str]:
+        return [name for name in os.listdir(self._directory)
+                if name.startswith(prefix) and not name.endswith('.tmp')]
+
+
+def create_backend(name: str, **kwargs) -> Backend:
+    """Create a storage backend by name.
+
+    Args:
+        name (str): Either `s3`, `local` or `memory`.
+        **kwargs: Passed on to the constructor of the backend, e.g.
+            `directory` for the local backend.
+
+    Returns:
+        Backend: The created backend.
+    """
+    if name == 's3':
+        # boto3 is only required when S3 is actually used.
+        from kvstore.s3 import S3Backend
+        return S3Backend(**kwargs)
+    elif name == 'local':
+        return LocalBackend(**kwargs)
+    elif name == 'memory':
+        return MemoryBackend(**kwargs)
+    raise ValueError('Unknown backend {}.'.format(name))
+
+
+def get_backend() -> Backend:
+    """Get the current storage backend.
+
+    If no backend was set, the S3 backend is used.
+    """
+    if Storage.BACKEND is None:
+        Storage.BACKEND = create_backend('s3')
+    return Storage.BACKEND
+
+
+def set_backend(backend: Backend):
+    """Set the storage backend to use for all items and the database.
+
+    Args:
+        backend (Backend): The backend to use.
+    """
+    Storage.BACKEND = backend
+
+
+def upload_file(filename: str, data: bytes):
+    """Upload a file to the current backend."""
+    return get_backend().upload_file(filename, data)
+
+
+def _cache_for(filename: str):
+    """Get the disk cache if enabled and the file can be cached in it.
+
+    Note:
+        This is a private function and should not be used.
+    """
+    cache = disk_cache()
+    if cache is None or not cache.cacheable(filename):
+        return None
+    return cache
+
+
+def download_file(filename: str) -> bytes:
+    """Download a file from the current backend.
+
+    Numbered objects are read from the disk cache if enabled, and added to it
+    once downloaded, see `kvstore.cache.DiskCache`.
+    """
+    cache = _cache_for(filename)
+    if cache is None:
+        return get_backend().download_file(filename)
+    data = cache.get(filename)
+    if data is None:
+        data = get_backend().download_file(filename)
+        cache.put(filename, data)
+    return data
+
+
+def download_range(filename: str, offset: int, length: int) -> bytes:
+    """Download a part of a file from the current backend.
+
+    With the disk cache enabled, a numbered object that is not cached yet is
+    downloaded as a whole once, so its other parts are read from disk later.
+    """
+    cache = _cache_for(filename)
+    if cache is None:
+        return get_backend().download_range(filename, offset, length)
+    data = cache.read(filename, offset, length)
+    if data is None:
+        # not through download_file, the miss is counted already
+        data = get_backend().download_file(filename)
+        cache.put(filename, data)
+        data = data[offset:offset + length]
+    return data
+
+
+def delete_file(filename: str) -> bool:
+    """Delete a file from the current backend and the disk cache."""
+    cache = _cache_for(filename)
+    if cache is not None:
+        cache.discard(filename)
+    return get_backend().delete_file(filename)
+
+
+def delete_files(filenames: typing.List[str]) -> bool:
+    """Delete several files from the current backend and the disk cache."""
+    for filename in filenames:
+        cache = _cache_for(filename)
+        if cache is not None:
+            cache.discard(filename)
+    return get_backend().delete_files(filenames)
+
+
+def list_files(prefix: str = '') -> typing.List[str]:
+    """List the files in the current backend."""
+    return get_backend().list_files(prefix)
@@ -0,0 +1,393 @@
+import collections
+import os
+import threading
+import typing
+
+from kvstore.config import config
+from kvstore.utils import random_string
+
+
+class ReferenceCache:
+    """The reference table, bounded by the number of entries and bytes.
+
+    The table maps keys to loaded items like a dictionary. Items are grouped by
+    the multi-item they are part of, and when the table is full the least
+    recently used group is evicted as a whole, since a multi-item is also
+    downloaded as a whole. Groups that are pinned, e.g. multi-items that are
+    not uploaded yet, are never evicted.
+
+    A limit of None falls back to the value in the configuration at the time
+    it is checked, so the limits can be configured after the table is created.
+
+    Args:
+        max_bytes (int or None): The maximum total length of the values of the
+            referenced items.
+        max_entries (int or None): The maximum number of referenced items.
+    """
+
+    def __init__(self, max_bytes: typing.Optional[int] = None,
+                 max_entries: typing.Optional[int] = None):
+        self._max_bytes = max_bytes
+        self._max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = {}
+        self._group_of = {}
+        # the groups in order of use, the least recently used group first.
+        self._groups = collections.OrderedDict()
+        self._pinned = set()
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+    def add(self, group: str, items: typing.Iterable['Item'],
+            pinned: bool = False):
+        """Reference items as part of a group.
+
+        Args:
+            group (str): The key of the multi-item the items are part of, or
+                the key of the item itself for a regular item.
+            items (list of Item): The items to reference.
+            pinned (bool): Whether the group may not be evicted.
+        """
+        with self._lock:
+            if pinned:
+                self._pinned.add(group)
+            for item in items:
+                self._discard(item.key)
+                self._items[item.key] = item
+                self._group_of[item.key] = group
+                self._bytes += len(item)
+                self._groups.setdefault(group, set()).add(item.key)
+            if group in self._groups:
+                self._groups.move_to_end(group)
+            self._evict()
+
+    @property
+    def max_bytes(self) -> typing.Optional[int]:
+        """int or None: The maximum total length of the values, None means
+        unbounded."""
+        if self._max_bytes is None:
+            return config.REFERENCES_MAX_BYTES
+        return self._max_bytes
+
+    @property
+    def max_entries(self) -> typing.Optional[int]:
+        """int or None: The maximum number of items, None means unbounded."""
+        if self._max_entries is None:
+            return config.REFERENCES_MAX_ENTRIES
+        return self._max_entries
+
+    def pin(self, group: str):
+        """Prevent a group from being evicted."""
+        with self._lock:
+            self._pinned.add(group)
+
+    def unpin(self, group: str):
+        """Allow a group to be evicted again, e.g. once it is uploaded."""
+        with self._lock:
+            self._pinned.discard(group)
+            self._evict()
+
+    def get(self, key: str, default=None):
+        """Get a referenced item and mark its group as recently used.
+
+        Args:
+            key (str): The key of the item.
+            default: The value to return if the item is not referenced.
+
+        Returns:
+            Item: The referenced item, or the default.
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._groups.move_to_end(self._group_of[key])
+            return item
+
+    def stats(self) -> dict:
+        """Get the counters and the current size of the table.
+
+        Returns:
+            dict: The hits, misses, evictions, entries and bytes.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._items),
+                'bytes': self._bytes
+            }
+
+    def clear(self):
+        """Remove all references."""
+        with self._lock:
+            self._items.clear()
+            self._group_of.clear()
+            self._groups.clear()
+            self._pinned.clear()
+            self._bytes = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._items
+
+    def __getitem__(self, key: str) -> 'Item':
+        return self._items[key]
+
+    def __delitem__(self, key: str):
+        with self._lock:
+            if key not in self._items:
+                raise KeyError(key)
+            self._discard(key)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _discard(self, key: str):
+        """Remove a reference if it exists.
+
+        Note:
+            This is a private method and should not be used.
+        """
+        item = self._items.pop(key, None)
+        if item is None:
+            return None
+        self._bytes -= len(item)
+        group = self._group_of.pop(key)
+        keys = self._groups[group]
+        keys.discard(key)
+        if not keys:
+            del self._groups[group]
+
+    def _evict(self):
+        """Evict the least recently used groups until within bounds.
+
+        Note:
+            This is a private method and should not be used.
+        """
+        max_bytes = self.max_bytes
+        max_entries = self.max_entries
+
+        def full():
+            return ((max_bytes is not None and self._bytes > max_bytes)
+                    or (max_entries is not None
+                        and len(self._items) > max_entries))
+
+        if not full():
+            return None
+        for group in list(self._groups):
+            if group in self._pinned:
+                continue
+            for key in list(self._groups[group]):
+                self._discard(key)
+            self.evictions += 1
+            if not full():
+                break
+
+
+class DiskCache:
+    """A size-bounded cache of downloaded objects in a local directory.
+
+    Numbered objects are never changed once uploaded, so a cached copy stays
+    valid until the object is deleted. Every object is stored as a file under
+    its own filename. Reading a part of a cached object only reads that part
+    of the file. Reads return copies, so no file is kept open. When the cache is full,
+    the least recently used objects are evicted. The order of use is kept in
+    the modification times of the files, so it survives restarts.
+
+    A directory should only be used by one process at a time.
+
+    Args:
+        directory (str): The directory to store the objects in. It is created
+            if it does not exist yet.
+        max_bytes (int): The maximum total size of the cached objects.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # the filenames in order of use, the least recently used file first.
+        self._files = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.tmp'):
+                # left behind by a crash while writing
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            found.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(found):
+            self._files[name] = size
+            self._bytes += size
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def cacheable(filename: str) -> bool:
+        """Check if a file is a numbered object, which never changes.
+
+        Args:
+            filename (str): The filename in the storage backend.
+
+        Returns:
+            bool: True if the file can be cached.
+        """
+        num, sep, _ = filename.partition('_')
+        return bool(sep) and num.isnumeric() and os.sep not in filename
+
+    def _open(self, filename: str) -> typing.Optional[typing.BinaryIO]:
+        """Open a cached object and mark it as recently used.
+
+        Note:
+            This is a private method and should not be used.
+        """
+        with self._lock:
+            if filename not in self._files:
+                self.misses += 1
+                return None
+            self._files.move_to_end(filename)
+        path = os.path.join(self.directory, filename)
+        try:
+            f = open(path, 'rb')
+            os.utime(path)
+        except FileNotFoundError:
+            self.discard(filename)
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return f
+
+    def get(self, filename: str) -> typing.Optional[bytes]:
+        """Get a cached object.
+
+        Args:
+            filename (str): The filename of the object.
+
+        Returns:
+            bytes or None: The object, or None if the object is not cached.
+        """
+        f = self._open(filename)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def read(self, filename: str, offset: int,
+             length: int) -> typing.Optional[bytes]:
+        """Read a part of a cached object.
+
+        Args:
+            filename (str): The filename of the object.
+            offset (int): The offset of the first byte to read.
+            length (int): The number of bytes to read.
+
+        Returns:
+            bytes or None: The requested part of the object, or None if the
+                object is not cached.
+        """
+        f = self._open(filename)
+        if f is None:
+            return None
+        with f:
+            f.seek(offset)
+            return f.read(length)
+
+    def put(self, filename: str, data: bytes):
+        """Add a downloaded object to the cache.
+
+        Objects larger than the whole cache are not cached.
+
+        Args:
+            filename (str): The filename of the object.
+            data (bytes): The content of the object.
+        """
+        if len(data) > self.max_bytes:
+            return None
+        path = os.path.join(self.directory, filename)
+        # write to a temporary file first, so a reader never reads a partial
+        # object, also not after a crash.
+        tmp_path = path + '.' + random_string(10) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._bytes -= self._files.pop(filename, 0)
+            self._files[filename] = len(data)
+            self._bytes += len(data)
+            self._evict()
+
+    def discard(self, filename: str):
+        """Remove an object from the cache if it is cached, e.g. once deleted.
+
+        Args:
+            filename (str): The filename of the object.
+        """
+        with self._lock:
+            size = self._files.pop(filename, None)
+            if size is None:
+                return None
+            self._bytes -= size
+        try:
+            os.remove(os.path.join(self.directory, filename))
+        except FileNotFoundError:
+            pass
+
+    def __len__(self) -> int:
+        """int: The number of cached objects."""
+        return len(self._files)
+
+    @property
+    def size(self) -> int:
+        """int: The total size of the cached objects in bytes."""
+        return self._bytes
+
+    def _evict(self):
+        """Evict the least recently used objects until within bounds.
+
+        Objects that are still open stay readable until they are closed.
+
+        Note:
+            This is a private method and should not be used.
+        """
+        while self._bytes > self.max_bytes and self._files:
+            filename, size = self._files.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+
+
+class Disk:
+    """Stores the reference to the disk cache in use."""
+    CACHE = None
+
+
+def disk_cache() -> typing.Optional[DiskCache]:
+    """Get the disk cache in the configured directory.
+
+    Returns:
+        DiskCache or None: The cache, or None if `DISK_CACHE_DIRECTORY` is not
+            set.
+    """
+    if not config.DISK_CACHE_DIRECTORY:
+        return None
+    if Disk.CACHE is None or \
+            Disk.CACHE.directory != config.DISK_CACHE_DIRECTORY:
+        Disk.CACHE = DiskCache(config.DISK_CACHE_DIRECTORY,
+                               config.DISK_CACHE_MAX_BYTES)
+    return Disk.CACHE
@@ -0,0 +1,145 @@
+import bz2
+import lzma
+import threading
+import typing
+import zlib
+
+"""The codecs by name, with the byte identifying them in the stored data."""
+CODECS = {
+    'zlib': 1,
+    'lzma': 2,
+    'bz2': 3
+}
+"""The number of bytes compressed to choose a codec with `auto`."""
+SAMPLE_SIZE = 2 ** 16
+
+
+def compress(codec: int, data: bytes) -> bytes:
+    """Compress data with a codec.
+
+    Args:
+        codec (int): The byte of the codec, see `CODECS`.
+        data (bytes): The data to compress.
+
+    Returns:
+        bytes: The compressed data.
+    """
+    if codec == CODECS['zlib']:
+        return zlib.compress(data)
+    elif codec == CODECS['lzma']:
+        return lzma.compress(data)
+    elif codec == CODECS['bz2']:
+        return bz2.compress(data)
+    raise ValueError('Unknown codec {}.'.format(codec))
+
+
+def decompress(codec: int, data: bytes) -> bytes:
+    """Decompress data compressed with `compress`.
+
+    Args:
+        codec (int): The byte of the codec, see `CODECS`.
+        data (bytes): The compressed data.
+
+    Returns:
+        bytes: The decompressed data.
+    """
+    if codec == CODECS['zlib']:
+        return zlib.decompress(data)
+    elif codec == CODECS['lzma']:
+        return lzma.decompress(data)
+    elif codec == CODECS['bz2']:
+        return bz2.decompress(data)
+    raise ValueError('Unknown codec {}.'.format(codec))
+
+
+def choose_codec(name: typing.Optional[str], data: bytes,
+                 min_saving: float) -> typing.Optional[int]:
+    """Choose the codec to compress data with.
+
+    With `auto`, a sample of the data is compressed with every codec, and the
+    codec with the best compression ratio is chosen. If even that codec saves
+    less than `min_saving` of the sample, the data is not worth compressing.
+
+    Args:
+        name (str or None): The name of a codec, `auto` or None for none.
+        data (bytes): The data to be compressed.
+        min_saving (float): The minimum fraction of bytes `auto` has to save.
+
+    Returns:
+        int or None: The byte of the codec, or None to store the data as is.
+    """
+    if name is None:
+        return None
+    if name != 'auto':
+        return CODECS[name]
+    sample = bytes(data[:SAMPLE_SIZE])
+    if not sample:
+        return None
+    sizes = {codec: len(compress(codec, sample)) for codec in CODECS.values()}
+    codec = min(sizes, key=sizes.get)
+    if sizes[codec] > (1 - min_saving) * len(sample):
+        return None
+    return codec
+
+
+class CompressedBlock:
+    """Values compressed together, decompressed once on first access.
+
+    Args:
+        codec (int): The byte of the codec.
+        data (bytes): The compressed values.
+        length (int): The total length of the decompressed values.
+    """
+
+    def __init__(self, codec: int, data: bytes, length: int):
+        self._codec = codec
+        self._compressed = data
+        self._length = length
+        self._data = None
+        self._lock = threading.Lock()
+
+    @property
+    def data(self) -> bytes:
+        """bytes: The decompressed values."""
+        with self._lock:
+            if self._data is None:
+                data = decompress(self._codec, self._compressed)
+                if len(data) != self._length:
+                    raise ValueError('Compressed values have length {} '
+                                     'instead of {}.'
+                                     .format(len(data), self._length))
+                self._data = data
+                self._compressed = None
+        return self._data
+
+    def slice(self, offset: int, length: int) -> 'CompressedSlice':
+        """Get a lazy slice of the decompressed values.
+
+        Args:
+            offset (int): The offset of the value in the decompressed values.
+            length (int): The length of the value.
+
+        Returns:
+            CompressedSlice: The slice, which decompresses on `tobytes`.
+        """
+        return CompressedSlice(self, offset, length)
+
+
+class CompressedSlice:
+    """A value within a `CompressedBlock`.
+
+    Like a memoryview, the length is known without decompressing, and the
+    value itself is only produced by `tobytes`.
+    """
+
+    def __init__(self, block: CompressedBlock, offset: int, length: int):
+        self._block = block
+        self._offset = offset
+        self._length = length
+
+    def tobytes(self) -> bytes:
+        """Decompress the block if needed and return the value."""
+        return self._block.data[self._offset:self._offset + self._length]
+
+    def __len__(self) -> int:
+        return self._length
@@ -0,0 +1,113 @@
+import threading
+import time
+
+from kvstore.backend import delete_files
+from kvstore.config import config
+from kvstore.database import sparse_multi_items, small_multi_item_runs, \
+    store_journal
+from kvstore.item import rewrite_multi_items
+
+
+class RateLimiter:
+    """Limits the number of bytes transferred per second.
+
+    The limiter is a token bucket holding at most a second worth of bytes. A
+    transfer larger than the bucket is allowed, after which the caller sleeps
+    until the bucket is refilled.
+
+    Args:
+        rate (int): The maximum number of bytes per second. 0 means no limit.
+    """
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self._allowance = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: int):
+        """Account for a transfer, sleeping if the rate is exceeded.
+
+        Args:
+            amount (int): The number of bytes transferred.
+        """
+        if not self.rate:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self.rate, self._allowance
+                                  + (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= amount
+            wait = -self._allowance / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def compact(threshold: float = None, limiter: RateLimiter = None) -> int:
+    """Compact the stored multi-items with many removed sub-items.
+
+    Each multi-item with a ratio of live bytes below the threshold is
+    rewritten with only its live sub-items. Once the journal delta switching
+    the index over is stored, the old multi-items are deleted in a batch.
+
+    Args:
+        threshold (float): The ratio of live bytes to stored bytes below which
+            a multi-item is compacted. Default is `COMPACTION_THRESHOLD` of the
+            configuration.
+        limiter (RateLimiter): Limits the bytes downloaded and uploaded.
+            Default is `COMPACTION_RATE` of the configuration.
+
+    Returns:
+        int: The number of compacted multi-items.
+    """
+    if threshold is None:
+        threshold = config.COMPACTION_THRESHOLD
+    if limiter is None:
+        limiter = RateLimiter(config.COMPACTION_RATE)
+    filenames = []
+    for key in sparse_multi_items(threshold):
+        try:
+            filenames += rewrite_multi_items([key], limiter)
+        except Exception as e:
+            print('compaction of {} failed: {}'.format(key, e))
+    if filenames:
+        # the old multi-items are only deleted once the index no longer
+        # refers to them after a restart.
+        store_journal()
+        delete_files(filenames)
+    return len(filenames)
+
+
+def merge(max_bytes: int = None, limiter: RateLimiter = None) -> int:
+    """Merge runs of small stored multi-items into larger multi-items.
+
+    Multi-items are sealed by count or age, which leaves many small objects.
+    Merging runs of multi-items with adjacent numbers cuts the number of
+    requests to read related keys, and the number of objects to list. Once the
+    journal delta switching the index over is stored, the merged multi-items
+    are deleted in a batch.
+
+    Args:
+        max_bytes (int): The target size of the merged multi-items in bytes.
+            Default is `MERGE_TARGET_BYTES` of the configuration.
+        limiter (RateLimiter): Limits the bytes downloaded and uploaded.
+            Default is `COMPACTION_RATE` of the configuration.
+
+    Returns:
+        int: The number of merged multi-items.
+    """
+    if max_bytes is None:
+        max_bytes = config.MERGE_TARGET_BYTES
+    if limiter is None:
+        limiter = RateLimiter(config.COMPACTION_RATE)
+    filenames = []
+    for keys in small_multi_item_runs(max_bytes):
+        try:
+            filenames += rewrite_multi_items(keys, limiter)
+        except Exception as e:
+            print('merging {} failed: {}'.format(', '.join(keys), e))
+    if filenames:
+        store_journal()
+        delete_files(filenames)
+    return len(filenames)
@@ -1,9 +1,114 @@
+import time
+import typing
+
+
+class SealPolicy:
+    """The policy deciding when the current multi-item is sealed and uploaded.
+
+    The multi-item is sealed as soon as the first of the limits is hit. A limit
+    of None falls back to the value in the configuration.
+
+    Args:
+        max_items (int): The maximum number of sub-items.
+        max_bytes (int): The maximum total length of the values in bytes.
+        max_age (float): The maximum number of seconds since the first
+            sub-item was added. 0 means no age limit.
+    """
+
+    def __init__(self, max_items: int = None, max_bytes: int = None,
+                 max_age: float = None):
+        self._max_items = max_items
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+
+    @property
+    def max_items(self) -> int:
+        """int: The maximum number of sub-items."""
+        if self._max_items is None:
+            return Config.MAX_MULTI_ITEM_SIZE
+        return self._max_items
+
+    @property
+    def max_bytes(self) -> int:
+        """int: The maximum total length of the values in bytes."""
+        if self._max_bytes is None:
+            return Config.MAX_MULTI_ITEM_BYTES
+        return self._max_bytes
+
+    @property
+    def max_age(self) -> float:
+        """float: The maximum age in seconds, or 0 for no age limit."""
+        if self._max_age is None:
+            return Config.MAX_MULTI_ITEM_AGE
+        return self._max_age
+
+    def is_full(self, multi_item) -> bool:
+        """Check if the multi-item hit the item count or byte limit.
+
+        Args:
+            multi_item (MultiItem): The multi-item to check.
+
+        Returns:
+            bool: True if the multi-item should be sealed.
+        """
+        return len(multi_item) >= self.max_items or \
+            multi_item.size >= self.max_bytes
+
+    def remaining(self, multi_item) -> typing.Optional[float]:
+        """Get the time until the multi-item hits the age limit.
+
+        Args:
+            multi_item (MultiItem or None): The multi-item to check.
+
+        Returns:
+            float or None: The remaining seconds, at most 0, or None if the
+                multi-item is empty or there is no age limit.
+        """
+        if multi_item is None or multi_item.created is None or \
+                not self.max_age:
+            return None
+        age = time.monotonic() - multi_item.created
+        return max(self.max_age - age, 0)
+
+    def is_expired(self, multi_item) -> bool:
+        """Check if the multi-item hit the age limit.
+
+        Args:
+            multi_item (MultiItem or None): The multi-item to check.
+
+        Returns:
+            bool: True if the multi-item should be sealed.
+        """
+        return self.remaining(multi_item) == 0
+
+
 class Config:
     """The configuration of the key-value store."""
     CURRENT_MULTI_ITEM = None
-    MAX_MULTI_ITEM_SIZE = 3
+    MAX_MULTI_ITEM_SIZE = 3 # sub-items
+    MAX_MULTI_ITEM_BYTES = 2 ** 20 # bytes of values
+    MAX_MULTI_ITEM_AGE = 5 # sec, 0 for no age limit
+    SEAL_POLICY = SealPolicy()
     DATABASE_DUMP_INTERVAL_ONLINE = 2 # sec
+    DATABASE_CHECKPOINT_DELTAS = 50 # journal deltas between checkpoints
+    DATABASE_SHARDS = 16 # objects a new index is split into
+    DATABASE_RETIRE_GRACE = 600 # sec replaced index shards and journal deltas are kept for readers
     DATABASE_FILENAME = 'count_test'
+    RECOVERY_WORKERS = 16 # concurrent downloads in download_missing
+    FETCH_WORKERS = 16 # concurrent downloads in get_many
+    REFERENCES_MAX_BYTES = 256 * 2 ** 20 # bytes of values in the reference table, None for no limit
+    REFERENCES_MAX_ENTRIES = 2 ** 20 # items in the reference table, None for no limit
+    WAL_DIRECTORY = 'kvstore_wal' # local write-ahead log, None to disable
+    DISK_CACHE_DIRECTORY = None # local cache of downloaded objects, None to disable
+    DISK_CACHE_MAX_BYTES = 2 ** 30 # bytes of cached objects on disk
+    COMPACTION_INTERVAL = 60 # sec between compaction passes, 0 to disable
+    COMPACTION_THRESHOLD = 0.5 # compact multi-items with a lower live ratio
+    COMPACTION_RATE = 2 ** 20 # bytes per sec of compaction I/O, 0 for no limit
+    MERGE_TARGET_BYTES = 4 * 2 ** 20 # bytes of values in merged multi-items
+    COMPRESSION = None # codec of multi-items: 'zlib', 'lzma', 'bz2', 'auto', 'zdict' or None
+    COMPRESSION_MIN_SAVING = 0.1 # 'auto' stores the values as is if saving less
+    ZDICT_SAMPLES = 1000 # values sampled to train a dictionary for 'zdict'
+    FORMAT_VERSION = 2 # format of new objects, 1 for the NULL separated format
 
 """Lower case variable for access."""
 config = Config
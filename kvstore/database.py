@@ -1,30 +1,64 @@
 # see the old/ directory for the sqlite3 code, I though we might just go with an in-memory database.
-import copy
-import enum
+import concurrent.futures
 import json
 import pickle
+import threading
+import time
 import typing
 
-from kvstore.exceptions import S3FileNotFoundError
-from kvstore.s3 import download_file, upload_file, delete_file, list_files
+from kvstore.backend import download_file, download_range, upload_file, delete_file, list_files, get_backend
+from kvstore.cache import ReferenceCache
+from kvstore.config import config
+from kvstore.exceptions import StorageFileNotFoundError
+from kvstore.index import ItemType, ShardedIndex, decode_index, encode_index
 
 DATABASE_TYPE = dict
 ITEM_TYPES = typing.Union['Item', 'MultiItem']
+"""The stored shards of the index and the journal delta they include."""
+S3_MANIFEST_FILENAME = 'kvstore_index.json'
+S3_INDEX_PREFIX = 'kvstore_index_'
+"""The checkpoints of older versions, only read if no manifest is stored."""
+S3_INDEX_FILENAME = 'kvstore_index.idx'
 S3_DATABASE_FILENAME = 'kvstore_database.pkl'
+S3_JOURNAL_PREFIX = 'kvstore_journal_'
 
 
 class Database:
-    """Stores the references to the database and the items."""
+    """Stores the references to the database and the items.
+
+    Next to the database itself, the journal of changes not yet uploaded is
+    kept here, with the futures of the journaled items that complete once the
+    journal is uploaded. `JOURNAL_SEQ` is the number of the last uploaded journal delta,
+    `CHECKPOINT_SEQ` the number of the last delta included in the stored
+    database and `JOURNAL_FILES` the numbers of the deltas still stored.
+    `INDEX` holds the shards of the database and `UNSTORED` the keys of the
+    multi-items that are not stored yet. `CHECKPOINT_CHANGES` is the number of
+    changes included in the stored database, and `SKIPPED_CHECKPOINTS` the
+    number of times storing was skipped since nothing changed, the last time
+    at `LAST_SKIPPED_CHECKPOINT`. `RETIRED` maps the filenames of the shards
+    and journal deltas replaced by a checkpoint to the time they were
+    replaced, they are deleted once older than the grace period. `BACKEND` is
+    the storage backend the database was loaded from.
+    """
     DATABASE = None
-    REFERENCES = {}
+    INDEX = None
+    BACKEND = None
+    UNSTORED = set()
+    # bounded by the limits in the configuration at the time of use
+    REFERENCES = ReferenceCache()
     LOADER = None
-
-
-class ItemType(enum.Enum):
-    """The possible types of the items."""
-    MULTI = 1
-    SUB = 2
-    REGULAR = 3
+    SUB_LOADER = None
+    LOCK = threading.RLock()
+    STORE_LOCK = threading.Lock()
+    JOURNAL = []
+    JOURNAL_WAITERS = []
+    JOURNAL_SEQ = 0
+    CHECKPOINT_SEQ = 0
+    JOURNAL_FILES = []
+    CHECKPOINT_CHANGES = 0
+    RETIRED = {}
+    SKIPPED_CHECKPOINTS = 0
+    LAST_SKIPPED_CHECKPOINT = None
 
 
 def database() -> dict:
@@ -32,7 +66,7 @@ def database() -> dict:
     return Database.DATABASE
 
 
-def references() -> dict:
+def references() -> ReferenceCache:
     """Get the current references."""
     return Database.REFERENCES
 
@@ -54,97 +88,550 @@ def with_context(type_: str):
     return with_database
 
 
-def database_set_loader(loader):
+def database_set_loader(loader, sub_loader=None):
     Database.LOADER = loader
+    Database.SUB_LOADER = sub_loader
+
+
+def journal_filename(seq: int) -> str:
+    """Create the filename for a journal delta.
+
+    Args:
+        seq (int): The number of the delta.
+
+    Returns:
+        str: The filename for the delta.
+    """
+    return '{}{:010d}.pkl'.format(S3_JOURNAL_PREFIX, seq)
+
+
+def index_filename(shard: int, version: int) -> str:
+    """Create the filename for a stored shard of the index.
+
+    Every checkpoint stores its changed shards under a new version, so the
+    shards of the previous checkpoint stay intact until it is replaced.
+
+    Args:
+        shard (int): The shard.
+        version (int): The version of the checkpoint.
+
+    Returns:
+        str: The filename for the shard.
+    """
+    return '{}{:04d}_{:010d}.idx'.format(S3_INDEX_PREFIX, shard, version)
+
+
+def _list_journal() -> typing.List[int]:
+    """List the numbers of all stored journal deltas in order.
+
+    Note:
+        This is a private function and should not be used.
+    """
+    seqs = []
+    for filename in list_files(S3_JOURNAL_PREFIX):
+        seq = filename[len(S3_JOURNAL_PREFIX):].split('.', 1)[0]
+        if seq.isnumeric():
+            seqs.append(int(seq))
+    return sorted(seqs)
+
+
+def _update_entry(database: DATABASE_TYPE, key: str, **fields):
+    """Update fields of the database entry of a key.
+
+    The entry is replaced by an updated copy, since snapshots of the database
+    share the entries, and it marks the shard as changed.
+
+    Note:
+        This is a private function and should not be used.
+
+    Args:
+        key (str): The key of the entry.
+    """
+    database['items'][key] = dict(database['items'][key], **fields)
+
+
+def _release_sub(database: DATABASE_TYPE, sub_data: dict):
+    """Subtract a sub-item that left its multi-item from the live bytes.
+
+    Note:
+        This is a private function and should not be used.
+
+    Args:
+        sub_data (dict): The database entry of the sub-item.
+    """
+    multi_data = database['items'].get(sub_data.get('part-of'))
+    if multi_data is not None and 'live' in multi_data and \
+            'length' in sub_data:
+        _update_entry(database, sub_data['part-of'],
+                      live=multi_data['live'] - sub_data['length'])
+
+
+@with_context('database')
+def _apply_journal(database: DATABASE_TYPE, entry: tuple):
+    """Apply a single journal entry to the database.
+
+    Applying an entry is idempotent, so entries already contained in the
+    stored database can safely be applied again.
+
+    Note:
+        This is a private function and should not be used.
+
+    Args:
+        entry (tuple): Either `('add', key, type, num, subs, size, zdict)`
+            with `subs` a list of `(sub_key, offset, length)` of the sub-items
+            pointing to the item, `size` the total length of all stored
+            values and `zdict` the version of the dictionary the values are
+            compressed with, `('delete', key)`, or `('compact', key)` for a
+            multi-item whose sub-items moved to another multi-item. Older
+            journals have no `size` and `zdict`.
+    """
+    if entry[0] == 'add':
+        _, key, type_, num, subs = entry[:5]
+        item_data = {
+            'type': type_,
+            'num': num
+        }
+        if type_ == ItemType.MULTI:
+            live = sum(length for _, _, length in subs)
+            item_data['bytes'] = entry[5] if len(entry) > 5 else live
+            item_data['live'] = live
+            if len(entry) > 6 and entry[6] is not None:
+                item_data['zdict'] = entry[6]
+        database['items'][key] = item_data
+        database['nums'][num] = key
+        database['current_num'] = max(database['current_num'], num)
+        Database.UNSTORED.discard(key)
+        for sub_key, offset, length in subs:
+            sub_data = database['items'].get(sub_key)
+            if sub_data is not None and sub_data.get('part-of') != key:
+                _release_sub(database, sub_data)
+            database['items'][sub_key] = {
+                'type': ItemType.SUB,
+                'part-of': key,
+                'offset': offset,
+                'length': length
+            }
+    elif entry[0] == 'delete':
+        item_data = database['items'].pop(entry[1], None)
+        if item_data is not None and 'num' in item_data:
+            database['nums'].pop(item_data['num'], None)
+        elif item_data is not None and item_data['type'] == ItemType.SUB:
+            _release_sub(database, item_data)
+    elif entry[0] == 'compact':
+        # the number stays reserved, so the old stored multi-item is never
+        # recovered by download_missing before it is deleted.
+        database['items'].pop(entry[1], None)
+    else:
+        raise ValueError('Unknown journal entry {}.'.format(entry[0]))
+
+
+@with_context('database')
+def journal_item(database: DATABASE_TYPE, item: ITEM_TYPES):
+    """Add a stored item to the journal.
+
+    This should be called once the item is uploaded, such that the next journal
+    delta registers the item and its sub-items in the stored database. The
+    location of each sub-item within the stored multi-item is registered as
+    well, so a sub-item can be downloaded on its own. Sub-items overwritten by
+    a newer version in the meantime are left out.
+
+    Args:
+        item (Item or MultiItem): The stored item.
+    """
+    offsets = item.offsets if hasattr(item, 'items') else {}
+    type_ = ItemType.MULTI if hasattr(item, 'items') else ItemType.REGULAR
+    with Database.LOCK:
+        num = numerate_key(item.key)
+        subs = []
+        for key, (offset, length) in offsets.items():
+            sub_data = database['items'].get(key)
+            if sub_data is not None and sub_data.get('part-of') == item.key:
+                if 'previous' in sub_data:
+                    # the version this one superseded is not stored anymore
+                    _release_sub(database, sub_data['previous'])
+                database['items'][key] = {
+                    'type': ItemType.SUB,
+                    'part-of': item.key,
+                    'offset': offset,
+                    'length': length
+                }
+                subs.append((key, offset, length))
+        size = sum(length for _, length in offsets.values())
+        if type_ == ItemType.MULTI:
+            # track the bytes of the sub-items still in the index, to find
+            # the multi-items worth compacting.
+            _update_entry(database, item.key, bytes=size,
+                          live=sum(length for _, _, length in subs))
+            if item.zdict is not None:
+                _update_entry(database, item.key, zdict=item.zdict)
+        Database.JOURNAL.append(('add', item.key, type_, num, subs, size,
+                                 getattr(item, 'zdict', None)))
+        Database.JOURNAL_WAITERS.append(item.persisted)
+
+
+def database_changes() -> int:
+    """Get the number of changes to the database since it was loaded.
+
+    Every entry added, updated or deleted is counted, see `_update_entry`, so
+    the database is unchanged as long as the number is.
+    """
+    if Database.INDEX is None:
+        return 0
+    return Database.INDEX.changes
+
+
+def skip_checkpoint():
+    """Record that storing the database was skipped since nothing changed."""
+    Database.SKIPPED_CHECKPOINTS += 1
+    Database.LAST_SKIPPED_CHECKPOINT = time.time()
+
+
+def journal_length() -> int:
+    """Get the number of journal deltas stored since the last checkpoint."""
+    return Database.JOURNAL_SEQ - Database.CHECKPOINT_SEQ
+
+
+def store_journal():
+    """Upload the changes since the last journal delta as a new delta.
+
+    Only the journal entries are uploaded, so the cost depends on the number of
+    changes instead of the size of the database. If nothing changed, nothing
+    is uploaded. Once uploaded, the futures of all items in the delta are
+    completed, so any number of writers share a single upload.
+    """
+    with Database.STORE_LOCK:
+        with Database.LOCK:
+            entries = Database.JOURNAL
+            waiters = Database.JOURNAL_WAITERS
+            if not entries:
+                return None
+            Database.JOURNAL = []
+            Database.JOURNAL_WAITERS = []
+        seq = Database.JOURNAL_SEQ + 1
+        try:
+            upload_file(journal_filename(seq), pickle.dumps(entries))
+        except Exception:
+            # put the entries back, so they are uploaded with the next delta.
+            with Database.LOCK:
+                Database.JOURNAL = entries + Database.JOURNAL
+                Database.JOURNAL_WAITERS = waiters + Database.JOURNAL_WAITERS
+            raise
+        Database.JOURNAL_SEQ = seq
+        Database.JOURNAL_FILES.append(seq)
+    for waiter in waiters:
+        if not waiter.done():
+            waiter.set_result(None)
+
+
+def _snapshot(shards: typing.Iterable[int] = None
+              ) -> typing.Tuple[ShardedIndex, int, int, typing.Set[str]]:
+    """Take a snapshot of the database to store.
+
+    Only the mappings changed since they were taken are copied, see
+    `ShardedIndex.snapshot`, so the snapshot is cheap to take and can be
+    encoded while the database is changed.
+
+    Note:
+        This is a private function and should not be used.
+
+    Args:
+        shards (iterable of int): The shards to copy, the shards that are
+            not copied should be unchanged since they were stored. Default is
+            all loaded shards.
+
+    Returns:
+        (ShardedIndex, int, int, set of str): The snapshot, the current
+            number, the number of the last journal delta included and the keys
+            of the multi-items not stored yet.
+    """
+    with Database.LOCK:
+        return Database.INDEX.snapshot(shards), database()['current_num'], \
+            Database.JOURNAL_SEQ, set(Database.UNSTORED)
 
 
 def dump_database() -> bytes:
-    """Dump the database and return.
+    """Dump the whole database and return.
 
-    The database is copied and any items that have not yet been stored are
-    removed. The remaining data is then dumped with pickle and returned.
+    Any items that have not yet been stored are left out. The number of the
+    last uploaded journal delta is stored as well, such that only later deltas
+    are applied when loading. The database is encoded as a single shard, see
+    `kvstore.index`, so every shard is downloaded. Only taking the snapshot
+    blocks writers, not the encoding.
 
     Returns:
-        bytes: The pickled data.
+        bytes: The encoded data.
     """
     if database() is None:
         return None
-    # remove items in the to-be-uploaded database that are not uploaded yet.
-    data = copy.deepcopy(database())
-    removed = set()
-    # first remove multi items, and keep a set of removed multi items.
-    for name, d in database()['items'].items():
-        if d['type'] == ItemType.MULTI and 'num' not in d:
-            del data['items'][name]
-            removed.add(name)
-    # then remove all sub items part of these multi items.
-    for name, d in database()['items'].items():
-        if d['type'] == ItemType.SUB and d['part-of'] in removed:
-            del data['items'][name]
-    return pickle.dumps(data)
+    index, current_num, seq, unstored = _snapshot()
+    return encode_index({'items': index.items, 'nums': index.nums,
+                         'current_num': current_num}, seq, unstored)
+
+
+def _shard_database(data: DATABASE_TYPE) -> ShardedIndex:
+    """Split a database stored by an older version into shards.
+
+    Note:
+        This is a private function and should not be used.
+    """
+    index = ShardedIndex(config.DATABASE_SHARDS)
+    for key, item_data in data['items'].items():
+        index.items[key] = item_data
+    for num, key in data['nums'].items():
+        index.nums[num] = key
+    return index
+
+
+def _download_checkpoint() -> typing.Tuple[ShardedIndex, int, int, dict]:
+    """Download the manifest of the last checkpoint of the database.
+
+    The shards themselves are only downloaded once they are looked up.
+    Checkpoints of older versions are downloaded and split into shards.
+
+    Note:
+        This is a private function and should not be used.
+
+    Returns:
+        (ShardedIndex, int, int, dict): The index, or None if no database was
+            stored, the current number, the number of the last journal delta
+            included and the retired files not deleted yet, see `Database`.
+    """
+    try:
+        manifest = json.loads(download_file(S3_MANIFEST_FILENAME))
+        index = ShardedIndex(len(manifest['shards']), manifest['shards'],
+                             download_file, manifest['version'])
+        return index, manifest['current_num'], manifest['journal_seq'], \
+            manifest.get('retired', {})
+    except StorageFileNotFoundError:
+        pass
+    try:
+        data, journal_seq = decode_index(download_file(S3_INDEX_FILENAME))
+    except StorageFileNotFoundError:
+        try:
+            data = pickle.loads(download_file(S3_DATABASE_FILENAME))
+        except StorageFileNotFoundError:
+            return None, 0, 0, {}
+        journal_seq = data.pop('journal_seq', 0)
+    return _shard_database(data), data['current_num'], journal_seq, {}
 
 
 def load_database():
     """Load the latest stored database.
 
-    The database is loaded from S3 and loaded with pickled, after which it is
-    stored. If no database was previously stored, an empty database and empty
-    reference table is created.
+    The manifest of the last checkpoint of the database is loaded from S3,
+    after which the journal deltas stored since are applied in order, which
+    downloads the shards they change. Checkpoints of older versions are loaded
+    as well. If no database was previously stored, an empty database and empty
+    reference table is created and all stored deltas are applied. Journal
+    entries not uploaded yet are applied last and kept, with the futures
+    waiting for them, to be uploaded with the next delta. If the database is
+    loaded from another backend, these entries are dropped and the futures
+    fail, so the write-ahead log of their multi-items is kept.
     """
-    try:
-        data = download_file(S3_DATABASE_FILENAME)
-    except S3FileNotFoundError:
+    backend = get_backend()
+    index, current_num, checkpoint_seq, retired = _download_checkpoint()
+    with Database.LOCK:
+        if Database.BACKEND is not backend:
+            for waiter in Database.JOURNAL_WAITERS:
+                if not waiter.done():
+                    waiter.set_exception(RuntimeError(
+                        'The database was loaded from another backend.'))
+            Database.JOURNAL = []
+            Database.JOURNAL_WAITERS = []
+            Database.BACKEND = backend
+        if index is None:
+            index = ShardedIndex(config.DATABASE_SHARDS)
+        Database.INDEX = index
         Database.DATABASE = {
-            'items': {},
-            'nums': {},
-            'current_num': 0
+            'items': index.items,
+            'nums': index.nums,
+            'current_num': current_num
         }
-        return None
-    Database.DATABASE = pickle.loads(data)
-
-
-def store_database(local: typing.Optional[str] = S3_DATABASE_FILENAME):
+        Database.UNSTORED = set()
+        Database.JOURNAL_FILES = _list_journal()
+        for seq in Database.JOURNAL_FILES:
+            if seq <= checkpoint_seq:
+                continue
+            for entry in pickle.loads(download_file(journal_filename(seq))):
+                _apply_journal(entry)
+        for entry in Database.JOURNAL:
+            _apply_journal(entry)
+        Database.CHECKPOINT_SEQ = checkpoint_seq
+        Database.JOURNAL_SEQ = max(Database.JOURNAL_FILES + [checkpoint_seq])
+        Database.CHECKPOINT_CHANGES = 0
+        Database.RETIRED = retired
+
+
+def store_database(local: typing.Optional[str] = S3_INDEX_FILENAME):
     """Store the database.
 
-    The database is dumped and stored online.
+    The shards of the database changed since the last checkpoint are stored
+    under a new version, followed by the manifest listing the stored shard of
+    every shard, which completes the checkpoint. The replaced shards and the
+    journal deltas included in the checkpoint are retired, and deleted by the
+    first checkpoint after `DATABASE_RETIRE_GRACE` seconds, so readers that
+    loaded an older manifest can still download the shards they look up. The
+    retired files are listed in the manifest, so they are also deleted after
+    a restart. The journal entries not uploaded yet are included in the
+    checkpoint as well, so they are dropped and the futures of their items
+    are completed. If nothing changed since the last checkpoint, nothing is
+    stored.
+
+    Writers are only blocked while a snapshot of the changed shards is taken,
+    the shards are encoded from the snapshot.
 
     Args:
-        local (str or None): Also store the database locally at this filename.
+        local (str or None): Also store the whole database locally at this
+            filename.
     """
-    print('storing database')
-    data = dump_database()
-    if local:
-        with open(local, 'wb') as f:
-            f.write(data)
-    return upload_file(S3_DATABASE_FILENAME, data)
+    with Database.STORE_LOCK:
+        with Database.LOCK:
+            index = Database.INDEX
+            changes = database_changes()
+            if changes == Database.CHECKPOINT_CHANGES and \
+                    Database.JOURNAL_SEQ == Database.CHECKPOINT_SEQ:
+                skip_checkpoint()
+                return None
+            print('storing database')
+            dirty = index.take_dirty()
+            snapshot, current_num, seq, unstored = _snapshot(dirty)
+            # the snapshot includes every journaled change
+            journaled = len(Database.JOURNAL)
+            waiters = list(Database.JOURNAL_WAITERS)
+        try:
+            shards = {}
+            for shard in dirty:
+                shard_data = dict(snapshot.shard(shard),
+                                  current_num=current_num)
+                shards[shard] = encode_index(shard_data, seq, unstored)
+            version = index.version + 1
+            filenames = list(snapshot.filenames)
+            for shard in dirty:
+                filenames[shard] = index_filename(shard, version)
+            now = time.time()
+            retired = dict(Database.RETIRED)
+            for filename in index.filenames:
+                if filename is not None and filename not in filenames:
+                    retired.setdefault(filename, now)
+            for old_seq in Database.JOURNAL_FILES:
+                if old_seq <= seq:
+                    retired.setdefault(journal_filename(old_seq), now)
+            expired = [filename for filename, retired_at in retired.items()
+                       if now - retired_at >= config.DATABASE_RETIRE_GRACE]
+            for filename in expired:
+                del retired[filename]
+            manifest = {
+                'version': version,
+                'shards': filenames,
+                'current_num': current_num,
+                'journal_seq': seq,
+                'retired': retired
+            }
+            if local:
+                with open(local, 'wb') as f:
+                    f.write(encode_index({'items': snapshot.items,
+                                          'nums': snapshot.nums,
+                                          'current_num': current_num},
+                                         seq, unstored))
+            for shard, shard_data in shards.items():
+                upload_file(filenames[shard], shard_data)
+            result = upload_file(S3_MANIFEST_FILENAME,
+                                 bytes(json.dumps(manifest), 'utf8'))
+        except Exception:
+            # store the shards again with the next checkpoint.
+            index.mark_dirty(dirty)
+            raise
+        index.filenames = filenames
+        index.version = version
+        Database.CHECKPOINT_SEQ = seq
+        Database.CHECKPOINT_CHANGES = changes
+        Database.JOURNAL_FILES = [s for s in Database.JOURNAL_FILES if s > seq]
+        Database.RETIRED = retired
+        with Database.LOCK:
+            Database.JOURNAL = Database.JOURNAL[journaled:]
+            Database.JOURNAL_WAITERS = Database.JOURNAL_WAITERS[len(waiters):]
+    for waiter in waiters:
+        if not waiter.done():
+            waiter.set_result(None)
+    for filename in expired:
+        delete_file(filename)
+    return result
+
+
+def store_changes(last_changes: int = None) -> int:
+    """Store the changes to the database of one interval.
+
+    The changes are uploaded as a journal delta, and once enough deltas are
+    stored, the database is stored as a checkpoint. If nothing changed since
+    the previous interval, nothing is done and the skip is recorded, so an
+    idle store costs no requests.
+
+    Args:
+        last_changes (int): The result of the previous interval.
+
+    Returns:
+        int: The number of changes, to pass to the next interval.
+    """
+    changes = database_changes()
+    if changes == last_changes and not Database.JOURNAL:
+        skip_checkpoint()
+        return changes
+    store_journal()
+    if journal_length() >= config.DATABASE_CHECKPOINT_DELTAS:
+        store_database(local=None)
+    return changes
 
 
 def _delete_database(from_s3: bool = False):
     """Delete the current database.
 
     Args:
-        from_s3 (bool): If True, remove the current stored database.
+        from_s3 (bool): If True, remove the current stored database and journal.
     """
     Database.DATABASE = None
+    Database.INDEX = None
+    Database.JOURNAL = []
+    Database.JOURNAL_WAITERS = []
     if from_s3:
-        return delete_file(S3_DATABASE_FILENAME)
+        for seq in _list_journal():
+            delete_file(journal_filename(seq))
+        Database.JOURNAL_FILES = []
+        for filename in list_files(S3_INDEX_PREFIX):
+            delete_file(filename)
+        delete_file(S3_DATABASE_FILENAME)
+        delete_file(S3_INDEX_FILENAME)
+        return delete_file(S3_MANIFEST_FILENAME)
 
 
 @with_context('references')
-def reference_item(references, item):
+def reference_item(references, item, group: str = None):
     """Reference an item in the reference table.
 
     If the item to reference is a multi-item, the sub-items are referenced
-    individually as well.
+    individually as well, as part of the group of the multi-item. Sub-items
+    overwritten by a version in another multi-item are left out. Items that
+    are not uploaded yet are pinned, so they are never evicted.
 
     Args:
         item (Item): The item to reference.
+        group (str): The key of the multi-item a single sub-item is part of.
+            Default is the key of the item itself.
     """
     if hasattr(item, 'items'):
-        for sub in item.items:
-            reference_item(sub)
+        items = [sub for sub in item.items if part_of(sub.key) == item.key]
+        references.add(item.key, items, pinned=not item.is_uploaded)
         return None
-    references[item.key] = item
+    references.add(group or item.key, [item], pinned=not item.is_uploaded)
+
+
+@with_context('references')
+def unpin_item(references, item: ITEM_TYPES):
+    """Allow an uploaded item to be evicted from the reference table.
+
+    Args:
+        item (Item or MultiItem): The uploaded item.
+    """
+    references.unpin(item.key)
 
 
 @with_context('references')
@@ -173,7 +660,9 @@ def get_item(database, references, key: str) -> 'Item':
 
     The item should be in the database, but may not be in the reference table
     yet. If the item is not in the reference table, it is downloaded and loaded
-    and added to the reference table.
+    and added to the reference table. If the location of a sub-item within its
+    multi-item is known, which is not the case for compressed multi-items,
+    only the value of the sub-item is downloaded.
 
     Args:
         key (str): The key for the item to get.
@@ -184,24 +673,387 @@ def get_item(database, references, key: str) -> 'Item':
     if not has_key(key):
         raise KeyError('Item with key does not exist.')
     key_data = database['items'][key]
-    if key not in references:
-        if key_data['type'] == ItemType.SUB:
-            multi_item_name = key_data['part-of']
-            if multi_item_name not in database['items']:
-                raise KeyError('Multi item does not exist. Faulty database?')
-            multi_item = database['items'][multi_item_name]
-            if 'num' not in multi_item:
-                raise Exception('Multi item was never uploaded.')
-            filename = str(multi_item['num']) + '_' + multi_item_name
+    item = references.get(key)
+    if item is not None:
+        return item
+    if key_data['type'] == ItemType.SUB:
+        multi_item_name = key_data['part-of']
+        if multi_item_name not in database['items']:
+            raise KeyError('Multi item does not exist. Faulty database?')
+        multi_item = database['items'][multi_item_name]
+        if 'num' not in multi_item:
+            raise Exception('Multi item was never uploaded.')
+        filename = str(multi_item['num']) + '_' + multi_item_name
+        try:
+            if key_data.get('offset') is not None:
+                value = download_range(filename, key_data['offset'],
+                                       key_data['length'])
+                if len(value) != key_data['length']:
+                    raise ValueError('Could not correctly read {} from {}.'
+                                     .format(key, filename))
+                item = Database.SUB_LOADER(key, value,
+                                           multi_item.get('zdict'))
+                reference_item(item, group=multi_item_name)
+                return item
             rawdata = download_file(filename)
-        elif key_data['type'] == ItemType.REGULAR:
-            rawdata = download_file(key)
-        item = Database.LOADER(rawdata, reloaded=True)
-        reference_item(item)
-    if key in references:
-        return references[key]
-    else:
-        raise Exception('Could not load item.')
+        except StorageFileNotFoundError:
+            # the multi-item may just have been compacted into another one
+            if database['items'].get(key) is not key_data:
+                return get_item(key)
+            raise
+    elif key_data['type'] == ItemType.REGULAR:
+        rawdata = download_file(key)
+    item = Database.LOADER(rawdata, reloaded=True)
+    reference_item(item)
+    if hasattr(item, 'items'):
+        if not item.has_item(key):
+            raise Exception('Could not load item.')
+        return item.get_item(key)
+    return item
+
+
+def _fetch_group(database, group: str,
+                 keys: typing.List[str]) -> typing.Dict[str, 'Item']:
+    """Download the items for keys stored in the same object with one request.
+
+    If the location of every sub-item is known, the range spanning their
+    values is downloaded, otherwise the whole multi-item. Items that are not
+    stored in a multi-item, or whose multi-item is not uploaded yet, are got
+    one by one.
+
+    Note:
+        This is a private function and should not be used.
+    """
+    multi_item = database['items'].get(group)
+    entries = [database['items'].get(key) for key in keys]
+    if multi_item is None or multi_item['type'] != ItemType.MULTI or \
+            'num' not in multi_item or None in entries:
+        return {key: get_item(key) for key in keys}
+    filename = str(multi_item['num']) + '_' + group
+    try:
+        if all(entry.get('offset') is not None for entry in entries):
+            start = min(entry['offset'] for entry in entries)
+            end = max(entry['offset'] + entry['length'] for entry in entries)
+            data = download_range(filename, start, end - start)
+            if len(data) != end - start:
+                raise ValueError('Could not correctly read {} values from {}.'
+                                 .format(len(keys), filename))
+            items = {}
+            for key, entry in zip(keys, entries):
+                offset = entry['offset'] - start
+                item = Database.SUB_LOADER(
+                    key, data[offset:offset + entry['length']],
+                    multi_item.get('zdict'))
+                reference_item(item, group=group)
+                items[key] = item
+            return items
+        rawdata = download_file(filename)
+    except StorageFileNotFoundError:
+        # the multi-item may just have been compacted into another one
+        return {key: get_item(key) for key in keys}
+    item = Database.LOADER(rawdata, reloaded=True)
+    reference_item(item)
+    items = {}
+    for key in keys:
+        if not item.has_item(key):
+            raise Exception('Could not load item.')
+        items[key] = item.get_item(key)
+    return items
+
+
+@with_context('references')
+@with_context('database')
+def get_items(database, references, keys: typing.Iterable[str],
+              workers: int = None) -> typing.Dict[str, 'Item']:
+    """Get many items from the reference table.
+
+    Items that are not in the reference table are grouped by the object they
+    are stored in, and every object is downloaded once, see `get_item`. The
+    objects are downloaded concurrently.
+
+    Args:
+        keys (iterable of str): The keys for the items to get.
+        workers (int): The maximum number of concurrent downloads. Default is
+            `FETCH_WORKERS` of the configuration.
+
+    Returns:
+        dict of str to SubItem: The items by their keys.
+    """
+    items = {}
+    groups = {}
+    for key in keys:
+        key_data = database['items'].get(key)
+        if key_data is None:
+            raise KeyError('Item with key {} does not exist.'.format(key))
+        item = references.get(key)
+        if item is not None:
+            items[key] = item
+            continue
+        group = key_data.get('part-of', key)
+        groups.setdefault(group, []).append(key)
+    if len(groups) == 1:
+        for group, group_keys in groups.items():
+            items.update(_fetch_group(database, group, group_keys))
+    elif groups:
+        workers = workers or config.FETCH_WORKERS
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            fetched = executor.map(lambda group: _fetch_group(
+                database, group, groups[group]), groups)
+            for group_items in fetched:
+                items.update(group_items)
+    return items
+
+
+@with_context('database')
+def sparse_multi_items(database: DATABASE_TYPE,
+                       threshold: float) -> typing.List[str]:
+    """List the stored multi-items with few sub-items left in the index.
+
+    Args:
+        threshold (float): The ratio of live bytes to stored bytes below which
+            a multi-item is listed.
+
+    Returns:
+        list of str: The keys of the multi-items, the sparsest first.
+    """
+    with Database.LOCK:
+        sparse = [(d['live'] / d['bytes'], key)
+                  for key, d in database['items'].items()
+                  if d['type'] == ItemType.MULTI and d.get('bytes')
+                  and 'num' in d and d['live'] < threshold * d['bytes']]
+    return [key for _, key in sorted(sparse)]
+
+
+def _worth_merging(run: typing.List[typing.Tuple[str, int]]
+                   ) -> typing.List[typing.List[str]]:
+    """Split a run around multi-items larger than the rest of the run.
+
+    Rewriting a multi-item is only worth it if the others add more live bytes
+    than it holds. So every byte is only rewritten once the multi-item holding
+    it at least doubles, and a merged multi-item is left alone until enough
+    new small multi-items follow it.
+
+    Note:
+        This is a private function and should not be used.
+    """
+    if len(run) < 2:
+        return []
+    total = sum(live for _, live in run)
+    largest = max(range(len(run)), key=lambda i: run[i][1])
+    if 2 * run[largest][1] >= total:
+        return _worth_merging(run[:largest]) + \
+            _worth_merging(run[largest + 1:])
+    return [[key for key, _ in run]]
+
+
+@with_context('database')
+def small_multi_item_runs(database: DATABASE_TYPE,
+                          max_bytes: int) -> typing.List[typing.List[str]]:
+    """List runs of small stored multi-items with adjacent numbers.
+
+    The stored items are walked in order of their number, and consecutive
+    multi-items are grouped as long as their live bytes fit in `max_bytes`
+    together. Any other item ends a run. A multi-item with more live bytes
+    than the rest of its run is left out, so merged multi-items are not
+    rewritten over and over for a little new data.
+
+    Args:
+        max_bytes (int): The maximum live bytes of a run.
+
+    Returns:
+        list of list of str: The keys of the multi-items of each run with at
+            least two multi-items.
+    """
+    runs = [[]]
+    size = 0
+    with Database.LOCK:
+        for num in sorted(database['nums']):
+            item_data = database['items'].get(database['nums'][num])
+            if item_data is None or item_data.get('num') != num:
+                # compacted multi-items only keep their number reserved
+                continue
+            live = item_data.get('live', max_bytes)
+            if item_data['type'] != ItemType.MULTI or live >= max_bytes:
+                runs.append([])
+                size = 0
+                continue
+            if size + live > max_bytes:
+                runs.append([])
+                size = 0
+            runs[-1].append((database['nums'][num], live))
+            size += live
+    return [keys for run in runs for keys in _worth_merging(run)]
+
+
+@with_context('database')
+def reserve_num(database: DATABASE_TYPE, key: str) -> int:
+    """Register a rewritten multi-item and reserve a number to store it under.
+
+    The sub-items are not registered, they are moved over by
+    `replace_multi_items` once the rewritten multi-item is stored.
+
+    Args:
+        key (str): The key of the rewritten multi-item.
+
+    Returns:
+        int: The number.
+    """
+    with Database.LOCK:
+        if key in database['items']:
+            raise KeyError('Key already in database.')
+        database['items'][key] = {
+            'type': ItemType.MULTI
+        }
+        return numerate_key(key)
+
+
+@with_context('database')
+def release_num(database: DATABASE_TYPE, key: str):
+    """Undo `reserve_num` if storing the rewritten multi-item failed.
+
+    Args:
+        key (str): The key of the rewritten multi-item.
+    """
+    with Database.LOCK:
+        item_data = database['items'].pop(key, None)
+        if item_data is not None and 'num' in item_data:
+            database['nums'].pop(item_data['num'], None)
+        Database.UNSTORED.discard(key)
+
+
+@with_context('database')
+def replace_multi_items(database: DATABASE_TYPE, old_keys: typing.List[str],
+                        item: 'MultiItem') -> int:
+    """Move the sub-items of stored multi-items to a rewritten multi-item.
+
+    Only the sub-items still part of one of the old multi-items are moved, so
+    sub-items removed since the old multi-items were read stay removed. For a
+    sub-item superseded by a version not journaled yet, only the stored
+    version it keeps as `previous` moves. The
+    old multi-items are removed from the index, and all changes are journaled
+    in the same delta, so the switch is atomic for anyone loading the database.
+
+    Args:
+        old_keys (list of str): The keys of the old multi-items.
+        item (MultiItem or None): The stored rewritten multi-item, with its
+            number reserved with `reserve_num`, or None if the old
+            multi-items have no sub-items left.
+
+    Returns:
+        int: The number of moved sub-items.
+    """
+    old_keys = set(old_keys)
+    subs = []
+    with Database.LOCK:
+        offsets = item.offsets if item is not None else {}
+        for key, (offset, length) in offsets.items():
+            sub_data = database['items'].get(key)
+            if sub_data is None:
+                continue
+            previous = sub_data.get('previous')
+            if previous is not None and previous.get('part-of') in old_keys:
+                # the newest version is not stored yet, so only the stored
+                # version it supersedes moves.
+                database['items'][key] = dict(sub_data, previous={
+                    'type': ItemType.SUB,
+                    'part-of': item.key,
+                    'offset': offset,
+                    'length': length
+                })
+                subs.append((key, offset, length))
+                continue
+            if sub_data.get('part-of') not in old_keys:
+                continue
+            # replace the entry instead of updating it, so readers holding the
+            # old entry notice the move.
+            database['items'][key] = {
+                'type': ItemType.SUB,
+                'part-of': item.key,
+                'offset': offset,
+                'length': length
+            }
+            subs.append((key, offset, length))
+        if item is not None:
+            size = sum(length for _, length in offsets.values())
+            _update_entry(database, item.key, bytes=size,
+                          live=sum(length for _, _, length in subs))
+            if item.zdict is not None:
+                _update_entry(database, item.key, zdict=item.zdict)
+            item_data = database['items'][item.key]
+            Database.JOURNAL.append(('add', item.key, ItemType.MULTI,
+                                     item_data['num'], subs, size, item.zdict))
+        for old_key in old_keys:
+            database['items'].pop(old_key, None)
+            Database.JOURNAL.append(('compact', old_key))
+    return len(subs)
+
+
+@with_context('database')
+def supersede_key(database: DATABASE_TYPE, key: str, multi_key: str):
+    """Point an existing key to the multi-item holding its newest version.
+
+    The superseded version stays in its stored multi-item until it is
+    compacted. Until the newest version is journaled, the entry keeps the
+    stored version as `previous`, which checkpoints store instead.
+
+    Args:
+        key (str): The key of the sub-item.
+        multi_key (str): The key of the multi-item with the newest version.
+    """
+    with Database.LOCK:
+        item_data = database['items'][key]
+        if item_data['type'] != ItemType.SUB:
+            raise ValueError('Only sub-items can be overwritten.')
+        if item_data.get('part-of') in Database.UNSTORED:
+            previous = item_data.get('previous')
+        else:
+            previous = {k: v for k, v in item_data.items() if k != 'previous'}
+            if 'previous' in item_data:
+                _release_sub(database, item_data['previous'])
+        entry = {
+            'type': ItemType.SUB,
+            'part-of': multi_key
+        }
+        if previous is not None:
+            entry['previous'] = previous
+        database['items'][key] = entry
+
+
+@with_context('database')
+def part_of(database: DATABASE_TYPE, key: str) -> typing.Optional[str]:
+    """Get the multi-item a sub-item is part of according to the index.
+
+    Args:
+        key (str): The key of the sub-item.
+
+    Returns:
+        str or None: The key of the multi-item, or None if the key is not a
+            sub-item (anymore).
+    """
+    item_data = database['items'].get(key)
+    if item_data is None:
+        return None
+    return item_data.get('part-of')
+
+
+@with_context('database')
+def stored_part_of(database: DATABASE_TYPE, key: str) -> typing.Optional[str]:
+    """Get the multi-item holding the stored version of a sub-item.
+
+    This differs from `part_of` while the newest version of the key is not
+    journaled yet.
+
+    Args:
+        key (str): The key of the sub-item.
+
+    Returns:
+        str or None: The key of the multi-item, or None if the key is not a
+            sub-item (anymore).
+    """
+    item_data = database['items'].get(key)
+    if item_data is None:
+        return None
+    return item_data.get('previous', item_data).get('part-of')
 
 
 @with_context('database')
@@ -292,6 +1144,7 @@ def add_multi_item(database: DATABASE_TYPE, item: 'MultiItem'):
     database['items'][item.key] = {
         'type': ItemType.MULTI
     }
+    Database.UNSTORED.add(item.key)
     _register_subs(item)
     reference_item(item)
 
@@ -311,12 +1164,39 @@ def update_multi_item(database: DATABASE_TYPE, item: 'MultiItem'):
     reference_item(item)
 
 
+@with_context('references')
+@with_context('database')
+def add_sub_items(database: DATABASE_TYPE, references,
+                  item: 'MultiItem', subs: typing.List['SubItem']):
+    """Register and reference sub-items just appended to a multi-item.
+
+    Unlike `update_multi_item`, only the given sub-items are handled, so an
+    append takes the same time however many sub-items the multi-item holds.
+
+    Args:
+        item (MultiItem): The multi-item the sub-items were appended to.
+        subs (list of SubItem): The appended sub-items.
+    """
+    if item.key not in database['items']:
+        raise KeyError('Multi item not found.')
+    for sub in subs:
+        # an overwritten key points to the multi-item already
+        if sub.key not in database['items']:
+            database['items'][sub.key] = {
+                'type': ItemType.SUB,
+                'part-of': item.key
+            }
+    references.add(item.key, subs, pinned=not item.is_uploaded)
+
+
 @with_context('database')
 def delete_item(database: DATABASE_TYPE, item: ITEM_TYPES, allow_sub: bool = False):
     """Delete an item.
 
-    If the item to be deleted is a MultiItem, the SubItems are individually
-    deleted first, after which the entire MultiItem is removed.
+    If the item to be deleted is a MultiItem, the SubItems still part of it
+    are individually deleted first, after which the entire MultiItem is
+    removed. SubItems overwritten by a newer version in another MultiItem are
+    left, but lose the version they keep from this one, see `supersede_key`.
 
     Note:
         'Remove' in this case means 'dereference'. The item will not be in the
@@ -334,12 +1214,25 @@ def delete_item(database: DATABASE_TYPE, item: ITEM_TYPES, allow_sub: bool = Fal
         raise ValueError('Cannot delete a sub-item.')
     if type_ == ItemType.MULTI:
         for sub in item.items:
-            delete_item(sub, allow_sub=True)
+            sub_data = database['items'].get(sub.key)
+            if sub_data is None:
+                continue
+            if sub_data.get('part-of') == item.key:
+                delete_item(sub, allow_sub=True)
+            elif sub_data.get('previous', {}).get('part-of') == item.key:
+                with Database.LOCK:
+                    database['items'][sub.key] = {
+                        k: v for k, v in sub_data.items() if k != 'previous'}
     if type_ != ItemType.SUB:
         n = database['items'][item.key]['num']
         if n:
             del database['nums'][n]
-    del database['items'][item.key]
+    with Database.LOCK:
+        if type_ == ItemType.SUB:
+            _release_sub(database, item_data.get('previous', item_data))
+        del database['items'][item.key]
+        Database.UNSTORED.discard(item.key)
+        Database.JOURNAL.append(('delete', item.key))
     dereference_item(item)
 
 
@@ -372,9 +1265,10 @@ def numerate_key(database: DATABASE_TYPE, key: str, num: int = None):
         new_high = num
     else:
         new_high = num if num > database['current_num'] else database['current_num']
-    item_data['num'] = num
+    _update_entry(database, key, num=num)
     database['nums'][num] = key
     database['current_num'] = new_high
+    Database.UNSTORED.discard(key)
     return num
 
 
@@ -3,7 +3,11 @@ class NotSupportedError(NotImplementedError):
     pass
 
 
-class S3FileNotFoundError(KeyError):
-    """The file on AWS S3 is not found."""
+class StorageFileNotFoundError(KeyError):
+    """The file is not found in the storage backend."""
     pass
 
+
+class S3FileNotFoundError(StorageFileNotFoundError):
+    """The file on AWS S3 is not found."""
+    pass
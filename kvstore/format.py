@@ -0,0 +1,205 @@
+"""The binary format of stored items, version 2.
+
+An object starts with a fixed header, little-endian:
+ - magic `\\x89KV2` (4 bytes), which no object of the first format starts with
+ - format version (1 byte)
+ - kind, `KIND_ITEM` or `KIND_MULTI` (1 byte)
+ - codec of the values, 0 for none (1 byte), see `kvstore.codec`
+ - reserved (1 byte)
+ - number of sub-items (4 bytes)
+ - version of the dictionary for `ZDICT_CODEC`, else 0 (4 bytes)
+ - offset of the values from the start of the object (4 bytes)
+ - CRC32 of everything after the fixed header (4 bytes)
+followed by
+ - the length of the key as varint, and the key
+for each sub-item
+ - the length of the key as varint, and the key
+ - the stored length of the value as varint
+ - the length of the value as varint
+then the offset table, with for each sub-item the offset of its stored value
+from the start of the values (4 bytes each), and finally the values. A regular
+item has no sub-items and its value is all data after the key.
+
+With a block codec, the values are compressed together and the offsets are
+those within the decompressed values.
+"""
+import struct
+import typing
+import zlib
+
+MAGIC = b'\x89KV2'
+VERSION = 2
+HEADER = struct.Struct('<4sBBBxIIII')
+OFFSET = struct.Struct('<I')
+KIND_ITEM = 0
+KIND_MULTI = 1
+"""The codec byte of values compressed one by one with a dictionary."""
+ZDICT_CODEC = 4
+
+
+def encode_varint(value: int) -> bytes:
+    """Encode an unsigned integer in 7 bits per byte, least significant first.
+
+    Args:
+        value (int): The integer to encode.
+
+    Returns:
+        bytes: The encoded integer.
+    """
+    data = bytearray()
+    while value >= 0x80:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def decode_varint(data: bytes, pos: int) -> typing.Tuple[int, int]:
+    """Decode an integer encoded with `encode_varint`.
+
+    Args:
+        data (bytes): The data to decode from.
+        pos (int): The offset of the integer in the data.
+
+    Returns:
+        (int, int): The integer and the offset after it.
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def is_object(data: bytes) -> bool:
+    """Check if data is an object of this format."""
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def _write_entries(key: str, entries: typing.List[typing.Tuple[str, int, int]]
+                   ) -> bytes:
+    """Dump the key of the item and the entries of the sub-items.
+
+    Note:
+        This is a private function and should not be used.
+    """
+    parts = []
+    for part_key, stored, length in [(key, None, None)] + entries:
+        part_key = bytes(part_key, 'utf8')
+        parts.append(encode_varint(len(part_key)))
+        parts.append(part_key)
+        if stored is not None:
+            parts.append(encode_varint(stored))
+            parts.append(encode_varint(length))
+    return b''.join(parts)
+
+
+def header_length(key: str,
+                  entries: typing.List[typing.Tuple[str, int, int]]) -> int:
+    """Get the offset of the values in an object, without dumping it.
+
+    Args:
+        key (str): The key of the item.
+        entries (list of (str, int, int)): The key, stored length and length
+            of each sub-item.
+
+    Returns:
+        int: The offset of the values.
+    """
+    return HEADER.size + len(_write_entries(key, entries)) + \
+        OFFSET.size * len(entries)
+
+
+def write_object(kind: int, key: str,
+                 entries: typing.List[typing.Tuple[str, int, int]],
+                 values: typing.List[bytes], codec: int = 0,
+                 zdict: int = 0) -> bytearray:
+    """Dump an item into a single preallocated buffer.
+
+    Args:
+        kind (int): `KIND_ITEM` or `KIND_MULTI`.
+        key (str): The key of the item.
+        entries (list of (str, int, int)): The key, stored length and length
+            of each sub-item.
+        values (list of bytes): The stored values, or the compressed block of
+            values.
+        codec (int): The codec of the values, 0 for none.
+        zdict (int): The version of the dictionary for `ZDICT_CODEC`.
+
+    Returns:
+        bytearray: The dumped object.
+    """
+    table = []
+    offset = 0
+    for _, stored, length in entries:
+        table.append(OFFSET.pack(offset))
+        # the offsets of a compressed block are those after decompressing
+        offset += length if codec and codec != ZDICT_CODEC else stored
+    head = _write_entries(key, entries) + b''.join(table)
+    values_offset = HEADER.size + len(head)
+    size = values_offset
+    for value in values:
+        size += len(value)
+    data = bytearray(size)
+    view = memoryview(data)
+    view[HEADER.size:values_offset] = head
+    pos = values_offset
+    for value in values:
+        view[pos:pos + len(value)] = value
+        pos += len(value)
+    crc = zlib.crc32(view[HEADER.size:])
+    HEADER.pack_into(data, 0, MAGIC, VERSION, kind, codec, len(entries),
+                     zdict, values_offset, crc)
+    view.release()
+    return data
+
+
+def read_object(data: bytes) -> typing.Tuple[
+        int, int, int, str, typing.List[typing.Tuple[str, int, int, int]],
+        int]:
+    """Load the header, key and entries of an object.
+
+    The checksum is verified, so corrupt and truncated objects are rejected.
+
+    Args:
+        data (bytes): The dumped object.
+
+    Returns:
+        (int, int, int, str, list of (str, int, int, int), int): The kind, the
+            codec, the version of the dictionary, the key, for each sub-item
+            the key, offset within the values, stored length and length, and
+            the offset of the values.
+
+    Raises:
+        ValueError: If the object is not valid.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError('Object is truncated.')
+    magic, version, kind, codec, count, zdict, values_offset, crc = \
+        HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError('Object has an unknown format.')
+    if version != VERSION:
+        raise ValueError('Object has unknown format version {}.'
+                         .format(version))
+    if zlib.crc32(memoryview(data)[HEADER.size:]) != crc:
+        raise ValueError('Object is corrupt, the checksum does not match.')
+    length, pos = decode_varint(data, HEADER.size)
+    key = str(data[pos:pos + length], 'utf8')
+    pos += length
+    entries = []
+    table_offset = values_offset - OFFSET.size * count
+    for i in range(count):
+        length, pos = decode_varint(data, pos)
+        sub_key = str(data[pos:pos + length], 'utf8')
+        stored, pos = decode_varint(data, pos + length)
+        length, pos = decode_varint(data, pos)
+        offset, = OFFSET.unpack_from(data, table_offset + OFFSET.size * i)
+        entries.append((sub_key, offset, stored, length))
+    if pos != table_offset:
+        raise ValueError('Object has an invalid header.')
+    return kind, codec, zdict, key, entries, values_offset
@@ -0,0 +1,643 @@
+"""A columnar encoding of the database index, split into shards.
+
+Pickling the index stores a dict and an enum for every key, which makes large
+indexes big and slow to load. The encoding here stores every field in its own
+column instead, with the keys sorted, so loading is a single read of a few
+arrays. Entries are only decoded when a key is looked up, with a binary
+search over the sorted keys. The index is split into shards, each stored
+on its own, so storing it only uploads the shards that changed, and loading
+it only downloads the shards that are looked up.
+
+The encoding starts with a fixed header, little-endian:
+ - magic `KVIX` (4 bytes)
+ - format version (1 byte)
+ - reserved (3 bytes)
+ - number of items (8 bytes)
+ - number of numbers (8 bytes)
+ - the current number (8 bytes)
+ - the number of the last journal delta included (8 bytes)
+ - CRC32 of everything after the fixed header (4 bytes)
+followed by the item columns
+ - the offsets of the keys in the key blob (one per item, plus one)
+ - the key blob, the sorted keys encoded with utf8
+ - the type of every item (1 byte each)
+ - the number of a multi-item or regular item, or for a sub-item the row of
+   its multi-item in the table of multi-items below
+ - the offset of a sub-item, or the stored bytes of a multi-item
+ - the length of a sub-item, or the live bytes of a multi-item
+ - the version of the dictionary of a multi-item
+ - the number of multi-items sub-items are part of (8 bytes)
+ - the offsets of the keys of these multi-items in their key blob (plus one)
+ - the key blob of these multi-items
+and the number columns
+ - the sorted numbers
+ - the offsets of the keys of the numbers in their key blob (plus one)
+ - the key blob of the numbers.
+Every column of integers starts with the width of its integers, 1, 2, 4 or 8
+bytes, the narrowest that fits all of them. Missing fields are stored as -1.
+
+Version 1 has no table of multi-items, a sub-item refers to the number of its
+multi-item instead. Since the number of a multi-item may be stored in another
+shard of the index, version 2 refers to the key.
+"""
+import array
+import collections.abc
+import enum
+import itertools
+import struct
+import sys
+import threading
+import typing
+import zlib
+
+MAGIC = b'KVIX'
+VERSION = 2
+HEADER = struct.Struct('<4sB3xqqqqI')
+PART_COUNT = struct.Struct('<q')
+"""The marker of a missing field in the columns."""
+MISSING = -1
+"""The typecodes of the arrays by the width of their integers."""
+TYPECODES = {array.array(typecode).itemsize: typecode
+             for typecode in 'qlihb'}
+
+
+class ItemType(enum.Enum):
+    """The possible types of the items."""
+    MULTI = 1
+    SUB = 2
+    REGULAR = 3
+
+
+def _column(data: bytes, pos: int, count: int) -> typing.Tuple[array.array, int]:
+    """Read a column of integers.
+
+    Note:
+        This is a private function and should not be used.
+    """
+    width = data[pos]
+    column = array.array(TYPECODES[width])
+    column.frombytes(data[pos + 1:pos + 1 + width * count])
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column, pos + 1 + width * count
+
+
+def _dump_column(values: typing.List[int]) -> bytes:
+    """Dump a column of integers, as narrow as the values allow.
+
+    Note:
+        This is a private function and should not be used.
+    """
+    low, high = (min(values), max(values)) if values else (0, 0)
+    for width in (1, 2, 4, 8):
+        if -2 ** (8 * width - 1) <= low and high < 2 ** (8 * width - 1):
+            break
+    column = array.array(TYPECODES[width], values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return bytes([width]) + column.tobytes()
+
+
+def _find(keys: bytes, key_offsets: array.array, key: bytes) -> int:
+    """Find the row of a key with a binary search over the sorted keys.
+
+    Note:
+        This is a private function and should not be used.
+
+    Returns:
+        int: The row, or -1 if the key is not in the keys.
+    """
+    low, high = 0, len(key_offsets) - 1
+    while low < high:
+        middle = (low + high) // 2
+        if keys[key_offsets[middle]:key_offsets[middle + 1]] < key:
+            low = middle + 1
+        else:
+            high = middle
+    if low < len(key_offsets) - 1 and \
+            keys[key_offsets[low]:key_offsets[low + 1]] == key:
+        return low
+    return -1
+
+
+class KeyColumns:
+    """Decoded keys, looked up by their row."""
+
+    def __init__(self, key_offsets: array.array, keys: bytes):
+        self._key_offsets = key_offsets
+        self._keys = keys
+
+    def get(self, row: int) -> str:
+        """Get the key in a row."""
+        return str(self._keys[self._key_offsets[row]:
+                              self._key_offsets[row + 1]], 'utf8')
+
+
+class NumColumns:
+    """The decoded numbers of the stored items, with the key of each number."""
+
+    def __init__(self, nums: array.array, keys: KeyColumns):
+        self._nums = nums
+        self._keys = keys
+
+    def __len__(self) -> int:
+        return len(self._nums)
+
+    def _row(self, num: int) -> int:
+        low, high = 0, len(self._nums)
+        while low < high:
+            middle = (low + high) // 2
+            if self._nums[middle] < num:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self._nums) and self._nums[low] == num:
+            return low
+        return -1
+
+    def __contains__(self, num: int) -> bool:
+        return self._row(num) >= 0
+
+    def get(self, num: int) -> typing.Optional[str]:
+        """Get the key of a number, or None if the number is not known."""
+        row = self._row(num)
+        return self._keys.get(row) if row >= 0 else None
+
+    def items(self) -> typing.Iterator[typing.Tuple[int, str]]:
+        """Iterate over the numbers in order, with their keys."""
+        for row, num in enumerate(self._nums):
+            yield num, self._keys.get(row)
+
+
+class ItemColumns:
+    """The decoded entries of the items, sorted by key.
+
+    The multi-item of a sub-item is looked up in `parts`, by row in version 2
+    and by number in version 1.
+    """
+
+    def __init__(self, key_offsets: array.array, keys: bytes, types: bytes,
+                 nums: array.array, offsets: array.array,
+                 lengths: array.array, zdicts: array.array,
+                 parts: typing.Union[KeyColumns, NumColumns]):
+        self._key_offsets = key_offsets
+        self._keys = keys
+        self._types = types
+        self._nums = nums
+        self._offsets = offsets
+        self._lengths = lengths
+        self._zdicts = zdicts
+        self._parts = parts
+
+    def __len__(self) -> int:
+        return len(self._types)
+
+    def __contains__(self, key: str) -> bool:
+        return _find(self._keys, self._key_offsets, bytes(key, 'utf8')) >= 0
+
+    def _entry(self, row: int) -> dict:
+        type_ = ItemType(self._types[row])
+        num = self._nums[row]
+        if type_ == ItemType.SUB:
+            entry = {
+                'type': type_,
+                'part-of': self._parts.get(num)
+            }
+            if self._offsets[row] != MISSING:
+                entry['offset'] = self._offsets[row]
+            if self._lengths[row] != MISSING:
+                entry['length'] = self._lengths[row]
+            return entry
+        entry = {'type': type_}
+        if num != MISSING:
+            entry['num'] = num
+        if type_ == ItemType.MULTI:
+            if self._offsets[row] != MISSING:
+                entry['bytes'] = self._offsets[row]
+                entry['live'] = self._lengths[row]
+            if self._zdicts[row] != MISSING:
+                entry['zdict'] = self._zdicts[row]
+        return entry
+
+    def get(self, key: str) -> typing.Optional[dict]:
+        """Decode the entry of a key, or None if the key is not known."""
+        row = _find(self._keys, self._key_offsets, bytes(key, 'utf8'))
+        return self._entry(row) if row >= 0 else None
+
+    def items(self) -> typing.Iterator[typing.Tuple[str, dict]]:
+        """Iterate over the keys in order, with their decoded entries."""
+        for row in range(len(self._types)):
+            key = str(self._keys[self._key_offsets[row]:
+                                 self._key_offsets[row + 1]], 'utf8')
+            yield key, self._entry(row)
+
+
+class LayeredMapping(collections.abc.MutableMapping):
+    """A mapping of changes on top of decoded columns.
+
+    The columns are never changed. An entry read from the columns is decoded
+    once and kept with the changes, so it can be updated in place like the
+    entry of a dict. Iterating goes over the keys in order.
+
+    Args:
+        base (ItemColumns or NumColumns or None): The decoded columns.
+        changes (dict): Entries on top of the columns.
+    """
+
+    def __init__(self, base=None, changes: dict = None):
+        self._base = base
+        self._changes = dict(changes or {})
+        self._removed = set()
+        self._length = len(self._changes)
+        if base is not None:
+            self._length += len(base) - sum(1 for key in self._changes
+                                             if key in base)
+
+    def __getitem__(self, key):
+        try:
+            return self._changes[key]
+        except KeyError:
+            pass
+        if self._base is None or key in self._removed:
+            raise KeyError(key)
+        value = self._base.get(key)
+        if value is None:
+            raise KeyError(key)
+        self._changes[key] = value
+        return value
+
+    def __contains__(self, key) -> bool:
+        if key in self._changes:
+            return True
+        return self._base is not None and key not in self._removed and \
+            key in self._base
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._length += 1
+        self._changes[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._changes.pop(key, None)
+        if self._base is not None and key in self._base:
+            self._removed.add(key)
+        self._length -= 1
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
+
+    def __iter__(self):
+        for key, _ in self.items():
+            yield key
+
+    def snapshot(self) -> 'LayeredMapping':
+        """Copy the mapping, sharing the columns and the entries.
+
+        Only the changes are copied. Entries are replaced instead of updated
+        in place, so the copy does not change along with the mapping.
+
+        Returns:
+            LayeredMapping: The copy.
+        """
+        snapshot = LayeredMapping(self._base)
+        snapshot._changes = self._changes.copy()
+        snapshot._removed = self._removed.copy()
+        snapshot._length = self._length
+        return snapshot
+
+    def items(self):
+        """Iterate over the keys in order, with their entries.
+
+        Entries not read before are decoded without keeping them, so they
+        should be looked up by key to update them.
+        """
+        changes = sorted(self._changes)
+        i = 0
+        if self._base is not None:
+            for key, value in self._base.items():
+                while i < len(changes) and changes[i] < key:
+                    yield changes[i], self._changes[changes[i]]
+                    i += 1
+                if key in self._changes or key in self._removed:
+                    continue
+                yield key, value
+        for key in changes[i:]:
+            yield key, self._changes[key]
+
+
+def key_shard(key: str, count: int) -> int:
+    """Get the shard of the index an item is stored in.
+
+    Args:
+        key (str): The key of the item.
+        count (int): The number of shards.
+
+    Returns:
+        int: The shard.
+    """
+    return zlib.crc32(bytes(key, 'utf8')) % count
+
+
+def num_shard(num: int, count: int) -> int:
+    """Get the shard of the index a number is stored in.
+
+    Args:
+        num (int): The number.
+        count (int): The number of shards.
+
+    Returns:
+        int: The shard.
+    """
+    return num % count
+
+
+class ShardedIndex:
+    """The database index, split into shards.
+
+    Items are put in a shard by the hash of their key, numbers by their
+    remainder, see `key_shard` and `num_shard`. Every shard is stored as its
+    own object, encoded with `encode_index`, and only downloaded once one of
+    its keys is looked up. The shards changed since they were last stored are
+    tracked, so only those have to be stored again, and `changes` counts every
+    change, so the index is unchanged as long as the count is.
+
+    Args:
+        count (int): The number of shards.
+        filenames (list of str or None): The stored object of every shard, or
+            None for shards never stored.
+        download (callable): Downloads a stored object by filename.
+        version (int): The version of the stored shards.
+    """
+
+    def __init__(self, count: int, filenames: typing.List[str] = None,
+                 download: typing.Callable[[str], bytes] = None,
+                 version: int = 0):
+        self.filenames = list(filenames or [None] * count)
+        self.version = version
+        self.changes = 0
+        self._download = download
+        self._shards = [None] * count
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self.items = ShardedMapping(self, 'items', key_shard)
+        self.nums = ShardedMapping(self, 'nums', num_shard)
+
+    def __len__(self) -> int:
+        return len(self._shards)
+
+    def shard(self, shard: int) -> dict:
+        """Get a shard, downloading it the first time.
+
+        Args:
+            shard (int): The shard.
+
+        Returns:
+            dict: The `items` and `nums` of the shard.
+        """
+        data = self._shards[shard]
+        if data is None:
+            with self._lock:
+                data = self._shards[shard]
+                if data is None:
+                    if self.filenames[shard] is None:
+                        data = {'items': LayeredMapping(),
+                                'nums': LayeredMapping()}
+                    else:
+                        data, _ = decode_index(
+                            self._download(self.filenames[shard]))
+                    self._shards[shard] = data
+        return data
+
+    def mark_dirty(self, shards: typing.Iterable[int]):
+        """Mark shards as changed since they were last stored."""
+        self._dirty.update(shards)
+        self.changes += 1
+
+    def snapshot(self, shards: typing.Iterable[int] = None) -> 'ShardedIndex':
+        """Copy the index, as of now.
+
+        Shards that are not copied are downloaded by the copy once looked up,
+        so they should be unchanged since they were stored.
+
+        Args:
+            shards (iterable of int): The shards to copy. Default is all
+                loaded shards.
+
+        Returns:
+            ShardedIndex: The copy.
+        """
+        snapshot = ShardedIndex(len(self), self.filenames, self._download,
+                                self.version)
+        if shards is None:
+            shards = [shard for shard, data in enumerate(self._shards)
+                      if data is not None]
+        for shard in shards:
+            data = self.shard(shard)
+            snapshot._shards[shard] = {'items': data['items'].snapshot(),
+                                       'nums': data['nums'].snapshot()}
+        return snapshot
+
+    def take_dirty(self) -> typing.Set[int]:
+        """Get the changed shards, and mark them as stored.
+
+        Returns:
+            set of int: The changed shards.
+        """
+        dirty, self._dirty = self._dirty, set()
+        return dirty
+
+
+class ShardedMapping(collections.abc.MutableMapping):
+    """The items or the numbers of all shards of a `ShardedIndex`.
+
+    Any key set or deleted marks its shard as changed. Entries updated in
+    place should be set again, so their shard is marked as well.
+
+    Args:
+        index (ShardedIndex): The index.
+        part (str): Either `items` or `nums`.
+        shard_of (callable): Gets the shard of a key.
+    """
+
+    def __init__(self, index: ShardedIndex, part: str,
+                 shard_of: typing.Callable[[typing.Any, int], int]):
+        self._index = index
+        self._part = part
+        self._shard_of = shard_of
+
+    def _locate(self, key) -> typing.Tuple[int, LayeredMapping]:
+        shard = self._shard_of(key, len(self._index))
+        return shard, self._index.shard(shard)[self._part]
+
+    def __getitem__(self, key):
+        return self._locate(key)[1][key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._locate(key)[1]
+
+    def __setitem__(self, key, value):
+        shard, mapping = self._locate(key)
+        mapping[key] = value
+        self._index.mark_dirty((shard,))
+
+    def __delitem__(self, key):
+        shard, mapping = self._locate(key)
+        del mapping[key]
+        self._index.mark_dirty((shard,))
+
+    def __len__(self) -> int:
+        return sum(len(self._index.shard(shard)[self._part])
+                   for shard in range(len(self._index)))
+
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
+
+    def __iter__(self):
+        for key, _ in self.items():
+            yield key
+
+    def items(self):
+        """Iterate over the entries of all shards, shard by shard."""
+        for shard in range(len(self._index)):
+            yield from self._index.shard(shard)[self._part].items()
+
+
+def _key_column(keys: typing.List[str]) -> typing.Tuple[bytes, bytes]:
+    """Dump keys as their offsets and the blob of keys.
+
+    Note:
+        This is a private function and should not be used.
+    """
+    encoded = [bytes(key, 'utf8') for key in keys]
+    return _dump_column([0] + list(itertools.accumulate(map(len, encoded)))), \
+        b''.join(encoded)
+
+
+def encode_index(database: dict, journal_seq: int,
+                 unstored: typing.Set[str] = frozenset()) -> bytes:
+    """Encode the database index.
+
+    Multi-items that have no number yet are not stored, and neither are their
+    sub-items. The entries are encoded in a single pass.
+
+    Args:
+        database (dict): The database, with `items`, `nums` and `current_num`.
+        journal_seq (int): The number of the last journal delta included.
+        unstored (set of str): The keys of the multi-items without a number,
+            of which the sub-items are left out.
+
+    Returns:
+        bytes: The encoded index.
+    """
+    items = database['items']
+    if not isinstance(items, LayeredMapping):
+        items = LayeredMapping(None, dict(items.items()))
+    sub, multi = ItemType.SUB, ItemType.MULTI
+    keys, types, nums, offsets, lengths, zdicts = [], [], [], [], [], []
+    parts = {}
+    for key, entry in items.items():
+        type_ = entry['type']
+        if type_ is sub:
+            part = entry['part-of']
+            if part in unstored:
+                # store the version the unstored one supersedes, if any
+                entry = entry.get('previous')
+                if entry is None:
+                    continue
+                part = entry['part-of']
+            nums.append(parts.setdefault(part, len(parts)))
+            offset = entry.get('offset')
+            offsets.append(MISSING if offset is None else offset)
+            lengths.append(entry.get('length', MISSING))
+        elif type_ is multi and 'num' not in entry:
+            continue
+        else:
+            nums.append(entry.get('num', MISSING))
+            offsets.append(entry.get('bytes', MISSING))
+            lengths.append(entry.get('live', MISSING))
+        keys.append(key)
+        types.append(type_)
+        zdicts.append(entry.get('zdict', MISSING))
+    num_keys = sorted(database['nums'].items())
+    body = [*_key_column(keys), bytes(type_.value for type_ in types)]
+    for column in (nums, offsets, lengths, zdicts):
+        body.append(_dump_column(column))
+    body.append(PART_COUNT.pack(len(parts)))
+    body.extend(_key_column(list(parts)))
+    body.append(_dump_column([num for num, _ in num_keys]))
+    body.extend(_key_column([key for _, key in num_keys]))
+    body = b''.join(body)
+    return HEADER.pack(MAGIC, VERSION, len(keys), len(num_keys),
+                       database['current_num'], journal_seq,
+                       zlib.crc32(body)) + body
+
+
+def is_index(data: bytes) -> bool:
+    """Check if data is an index encoded with `encode_index`."""
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def decode_index(data: bytes) -> typing.Tuple[dict, int]:
+    """Decode an index encoded with `encode_index`.
+
+    Only the columns are read, the entries are decoded once looked up.
+
+    Args:
+        data (bytes): The encoded index.
+
+    Returns:
+        (dict, int): The database, and the number of the last journal delta
+            included.
+
+    Raises:
+        ValueError: If the index is not valid.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError('Index is truncated.')
+    magic, version, count, num_count, current_num, journal_seq, crc = \
+        HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError('Index has an unknown format.')
+    if version not in (1, VERSION):
+        raise ValueError('Index has unknown format version {}.'
+                         .format(version))
+    view = memoryview(data)
+    if zlib.crc32(view[HEADER.size:]) != crc:
+        raise ValueError('Index is corrupt, the checksum does not match.')
+    key_offsets, pos = _column(view, HEADER.size, count + 1)
+    keys = bytes(view[pos:pos + key_offsets[-1]])
+    pos += key_offsets[-1]
+    types = bytes(view[pos:pos + count])
+    pos += count
+    nums, pos = _column(view, pos, count)
+    offsets, pos = _column(view, pos, count)
+    lengths, pos = _column(view, pos, count)
+    zdicts, pos = _column(view, pos, count)
+    if version > 1:
+        part_count, = PART_COUNT.unpack_from(view, pos)
+        part_offsets, pos = _column(view, pos + PART_COUNT.size,
+                                    part_count + 1)
+        parts = KeyColumns(part_offsets,
+                           bytes(view[pos:pos + part_offsets[-1]]))
+        pos += part_offsets[-1]
+    num_column, pos = _column(view, pos, num_count)
+    num_key_offsets, pos = _column(view, pos, num_count + 1)
+    num_columns = NumColumns(num_column, KeyColumns(
+        num_key_offsets, bytes(view[pos:pos + num_key_offsets[-1]])))
+    if pos + num_key_offsets[-1] != len(data):
+        raise ValueError('Index has an invalid length.')
+    if version == 1:
+        # sub-items referred to the number of their multi-item
+        parts = num_columns
+    database = {
+        'items': LayeredMapping(ItemColumns(key_offsets, keys, types, nums,
+                                            offsets, lengths, zdicts, parts)),
+        'nums': LayeredMapping(num_columns),
+        'current_num': current_num
+    }
+    return database, journal_seq
@@ -1,9 +1,25 @@
+import concurrent.futures
+import queue
+import threading
+import time
 import typing
 
-from kvstore.database import has_key, add_item, add_multi_item, update_multi_item, load_database, numerate_key, num_exists
+from kvstore.codec import CompressedBlock, choose_codec, compress
+from kvstore.config import config
+from kvstore.database import has_key, has_num, add_item, add_multi_item, add_sub_items, load_database, numerate_key, \
+    num_exists, journal_item, unpin_item, part_of, stored_part_of, supersede_key, reserve_num, release_num, replace_multi_items
 from kvstore.exceptions import NotSupportedError
-from kvstore.s3 import upload_file, download_file, delete_file, list_files
+from kvstore.format import KIND_ITEM, KIND_MULTI, ZDICT_CODEC, header_length, is_object, read_object, write_object
+from kvstore.backend import upload_file, download_file, delete_file, list_files
 from kvstore.utils import random_string
+from kvstore.wal import write_ahead_log, log_item, remove_log
+from kvstore.zdict import DictionarySlice, current_dictionary, compress_value, decompress_value
+
+"""Full multi-items waiting to be uploaded, in order of sealing. A None entry
+only wakes up the watcher."""
+SEAL_QUEUE = queue.Queue()
+"""Held while appending to or swapping the current multi-item."""
+SEAL_LOCK = threading.RLock()
 
 
 class ItemBase:
@@ -21,6 +37,10 @@ class ItemBase:
         self._reloaded = reloaded
         self.key = key
         self._is_uploaded = is_uploaded
+        self._persisted = concurrent.futures.Future()
+        if reloaded:
+            # a reloaded item was loaded through the stored database
+            self._persisted.set_result(None)
 
     @property
     def key(self) -> str:
@@ -49,6 +69,29 @@ class ItemBase:
     def is_uploaded(self, _):
         raise NotSupportedError('Uploaded status cannot be set manually.')
 
+    @property
+    def persisted(self) -> concurrent.futures.Future:
+        """Future: Completes once the item is uploaded and registered in the
+        stored database.
+
+        The sub-items of a multi-item share the future of the multi-item, so
+        all writers of a multi-item wait for the same upload.
+        """
+        return self._persisted
+
+    def wait(self, timeout: float = None):
+        """Wait until the item is uploaded and registered in the stored
+        database.
+
+        Args:
+            timeout (float): The maximum number of seconds to wait. Default is
+                to wait indefinitely.
+
+        Raises:
+            concurrent.futures.TimeoutError: If the timeout passed.
+        """
+        self._persisted.result(timeout)
+
     def _reset_data(self):
         """Reset the data in the item."""
         self._data = None
@@ -75,10 +118,17 @@ class Item(ItemBase):
         data = self._write_item()
         upload_file(create_filename(self._key), data)
         self._is_uploaded = True
+        unpin_item(self)
+        journal_item(self)
 
     @property
     def value(self) -> bytes:
         """bytes: Get the value of the of item."""
+        if hasattr(self._value, 'tobytes'):
+            # values read from a multi-item are zero-copy slices of the raw
+            # data, or slices of compressed values, which are only copied or
+            # decompressed once the value is actually used.
+            self._value = self._value.tobytes()
         return self._value
 
     @value.setter
@@ -89,12 +139,12 @@ class Item(ItemBase):
     @property
     def str(self) -> str:
         """str: The string representation of the value of the item."""
-        return str(self._value, 'utf8')
+        return str(self.value, 'utf8')
 
     @property
     def bytes(self) -> bytes:
         """Return the bytes representation of the value of the item."""
-        return self._value
+        return self.value
 
     def __len__(self):
         """The length of the value of the item."""
@@ -106,24 +156,25 @@ class Item(ItemBase):
             return None
         return delete_file(self._key)
 
-    def _write_item(self) -> bytes:
+    def _write_item(self) -> bytearray:
         """Dump the item to a representation to be uploaded.
 
-        This contain a list of bytes values concatentated with the NULL byte:
+        With `FORMAT_VERSION` 2, see `kvstore.format`. Else this contain a list
+        of bytes values concatentated with the NULL byte:
          - `s`
          - key
          - value
 
         Returns:
-            bytes: The dumped data.
+            bytearray: The dumped data.
         """
         if hasattr(self, '_data') and self._data is not None:
             return self._data
-        data = b's\0'
-        data += bytes(self._key, 'utf8')
-        data += b'\0'
-        data += self._value
-        self._data = data
+        if config.FORMAT_VERSION >= 2:
+            self._data = write_object(KIND_ITEM, self._key, [], [self.value])
+            return self._data
+        header = b's\0' + bytes(self._key, 'utf8') + b'\0'
+        self._data = _fill_buffer(header, [self.value])
         return self._data
 
 
@@ -143,7 +194,7 @@ class SubItem(Item):
         Returns:
             Item: The new item with value copied from the current sub-item.
         """
-        return Item(key, self._value)
+        return Item(key, self.value)
 
     @Item.is_uploaded.setter
     def is_uploaded(self, value: bool):
@@ -167,26 +218,46 @@ class MultiItem(ItemBase):
             value is False.
         reloaded (bool): Whether the multi-item is reloaded or not. Default
             value is False.
+        start (int): The offset in `rawdata` at which the data of the
+            multi-item starts. Default value is 0.
+        type_ (bytes): The type of `rawdata`, see `load_data`. Default value
+            is `m`.
     """
 
     def __init__(self, key: str = None, rawdata: bytes = None,
-                 is_uploaded: bool = False, reloaded: bool = False):
+                 is_uploaded: bool = False, reloaded: bool = False,
+                 start: int = 0, type_: bytes = b'm'):
         super().__init__(key or self._create_key(), is_uploaded, reloaded)
+        self._reset_data()
         if rawdata is not None:
-            self._items = self._read_item(rawdata)
+            self._items = self._read_item(rawdata, start, type_)
         else:
             self._items = {}
+        self._size = sum(len(item) for item in self._items.values())
+        self._created = None
 
     def upload(self):
         """Store the multi-item."""
         # dump the multi-item
         data = self._write_item()
-        # upload the dumped data
-        upload_file(create_filename(self._key), data)
+        # upload the dumped data, letting anyone waiting know if this fails
+        try:
+            upload_file(create_filename(self._key), data)
+        except Exception as e:
+            self._persisted.set_exception(e)
+            raise
         # and set is_uploaded to True for all
         self._is_uploaded = True
         for item in self._items.values():
             item.is_uploaded = True
+        unpin_item(self)
+        # register the stored multi-item in the next journal delta
+        journal_item(self)
+        # the local log of the multi-item is only needed until it is persisted
+        def remove(future):
+            if future.exception() is None:
+                remove_log(self._key)
+        self._persisted.add_done_callback(remove)
 
     def has_item(self, key: str) -> bool:
         """Check if this multi-item has a sub-item with certain key.
@@ -221,35 +292,125 @@ class MultiItem(ItemBase):
         if not has_key(key):
             raise KeyError('Item not found.')
         self._reset_data()
+        self._size -= len(self._items[key])
         del self._items[key]
 
-    def append_item(self, item: Item):
+    def append_item(self, item: Item, overwrite: bool = False):
         """Append an existing item to the multi-item.
 
         The actually added item is a sub-item with the key and value copied from
-        the regular item.
+        the regular item. If this is the current multi-item, the key-value pair
+        is written to the write-ahead log first, and if it is full according to
+        the seal policy, it is sealed right away.
 
         Args:
             item (Item): The item to add.
+            overwrite (bool): Allow the key to exist already, in which case
+                the item becomes the newest version of the key.
+
+        Returns:
+            SubItem: The appended sub-item.
         """
-        if has_key(item.key):
-            raise KeyError('Key already exists.')
-        self._reset_data()
-        self._items[item.key] = SubItem(item.key, item.value)
-        if len(self._items) == 1:
-            add_multi_item(self)
-        update_multi_item(self)
+        return self._append(item.key, item.value, overwrite)
 
-    def append_key_value(self, key: str, value: bytes):
+    def append_key_value(self, key: str, value: bytes,
+                         overwrite: bool = False):
         """Append a key-value pair to the multi-item.
 
         Args:
             key (str): The key of the item.
             value (bytes): The value of the item.
+            overwrite (bool): Allow the key to exist already, in which case
+                the value becomes the newest version of the key.
+
+        Returns:
+            SubItem: The appended sub-item.
+        """
+        return self._append(key, value, overwrite)
+
+    def _append(self, key: str, value: bytes, overwrite: bool) -> Item:
+        """Append a key-value pair, see `append_item`.
+
+        Note:
+            This is a private method and should not be used.
+        """
+        subs = []
+        self._append_many([(key, value, check_key(key, overwrite))], 0, subs)
+        return subs[0]
+
+    def _append_many(self, pairs: typing.List[typing.Tuple[str, bytes, bool]],
+                     start: int = 0, subs: typing.List[Item] = None) -> int:
+        """Append checked key-value pairs until the multi-item is full.
+
+        Only the new sub-items are registered in the database and the
+        reference table, once for all appended pairs, so appending takes the
+        same time however many sub-items the multi-item holds.
+
+        Note:
+            This is a private method and should not be used.
+
+        Args:
+            pairs (list of (str, bytes, bool)): The keys and values, with for
+                each key if it exists already, see `check_key`.
+            start (int): The index of the first pair to append.
+            subs (list of SubItem): Extended with the created sub-items.
+
+        Returns:
+            int: The index after the last appended pair. If this is the
+                current multi-item, appending stops once it is full according
+                to the seal policy, and it is sealed.
         """
-        if has_key(key):
-            raise KeyError('Key already exists.')
-        return self.append_item(SubItem(key, value))
+        if start >= len(pairs):
+            return start
+        current = self is config.CURRENT_MULTI_ITEM
+        first = not self._items
+        self._reset_data()
+        appended = []
+        end = start
+        while end < len(pairs):
+            key, value, exists = pairs[end]
+            end += 1
+            if current:
+                log_item(self._key, key, value)
+            # the key of an overwritten sub-item is registered already
+            sub = SubItem(key, value, reloaded=exists)
+            sub._persisted = self._persisted
+            old = self._items.get(key)
+            if old is not None:
+                # overwriting a sub-item that is not uploaded yet replaces it
+                self._size -= len(old)
+            elif exists:
+                # the older version is left in its multi-item for compaction
+                supersede_key(key, self._key)
+            self._items[key] = sub
+            self._size += len(sub)
+            appended.append(sub)
+            if current and config.SEAL_POLICY.is_full(self):
+                break
+        if first:
+            self._created = time.monotonic()
+            add_multi_item(self)
+        else:
+            add_sub_items(self, appended)
+        if subs is not None:
+            subs.extend(appended)
+        if current:
+            if config.SEAL_POLICY.is_full(self):
+                seal_multi_item()
+            elif first and config.SEAL_POLICY.max_age:
+                # wake up the watcher, to seal the multi-item once it is too old
+                SEAL_QUEUE.put(None)
+        return end
+
+    @property
+    def size(self) -> int:
+        """int: The total length of the values of the sub-items in bytes."""
+        return self._size
+
+    @property
+    def created(self) -> typing.Optional[float]:
+        """float or None: The monotonic time the first sub-item was added."""
+        return self._created
 
     @property
     def items(self) -> typing.List[Item]:
@@ -269,46 +430,212 @@ class MultiItem(ItemBase):
         """
         return list(self._items.keys())
 
-    def _read_item(self, rawdata: bytes) -> typing.Dict[str, Item]:
+    @property
+    def zdict(self) -> typing.Optional[int]:
+        """int or None: The version of the dictionary the values are
+        compressed with one by one, see `kvstore.zdict`."""
+        return self._zdict
+
+    @property
+    def offsets(self) -> typing.Dict[str, typing.Tuple[int, int]]:
+        """Get the location of the value of each sub-item in the dumped data.
+
+        The offsets follow from the layout described in `_write_item`, without
+        having to dump the multi-item. If the multi-item was dumped with
+        compressed values, a value cannot be read on its own, so the offset is
+        None. If the values were compressed with a dictionary, the offset and
+        length are those of the compressed value.
+
+        Returns:
+            dict of str to (int or None, int): The offset and length of the
+                value of each sub-item, by key of the sub-item.
+        """
+        items = list(self._items.items())
+        if self._codec is not None:
+            return {key: (None, len(item)) for key, item in items}
+        entries = self._entries(items)
+        if (self._format or config.FORMAT_VERSION) >= 2:
+            offset = header_length(self._key, entries)
+        else:
+            offset = len(self._write_header(items, zdict=self._zdict,
+                                            stored=self._stored))
+        offsets = {}
+        for key, stored, _ in entries:
+            offsets[key] = (offset, stored)
+            offset += stored
+        return offsets
+
+    def _entries(self, items: typing.List[typing.Tuple[str, Item]]
+                 ) -> typing.List[typing.Tuple[str, int, int]]:
+        """Get the key, stored length and length of the value of sub-items.
+
+        Note:
+            This is a private method and should not be used.
+        """
+        if self._stored is None:
+            return [(key, len(item), len(item)) for key, item in items]
+        return [(key, self._stored[key], len(item)) for key, item in items]
+
+    def _reset_data(self):
+        """Reset the dumped data and how the values were compressed."""
+        super()._reset_data()
+        self._format = None
+        self._codec = None
+        self._zdict = None
+        self._stored = None
+
+    def _load_object(self, data: bytes, codec: int, zdict: int,
+                     entries: typing.List[typing.Tuple[str, int, int, int]],
+                     values_offset: int):
+        """Load the sub-items from an object read with `read_object`.
+
+        Like `_read_item`, the values are zero-copy slices of the data, and
+        compressed values are only decompressed once a value is used.
+
+        Note:
+            This is a private method and should not be used.
+        """
+        self._format = 2
+        view = memoryview(data)[values_offset:]
+        if codec == ZDICT_CODEC:
+            self._zdict = zdict
+            self._stored = {}
+        elif codec:
+            self._codec = codec
+            block = CompressedBlock(codec, view, sum(e[3] for e in entries))
+        self._items = {}
+        for key, offset, stored, length in entries:
+            if codec == ZDICT_CODEC:
+                value = DictionarySlice(zdict, view[offset:offset + stored],
+                                        length)
+                self._stored[key] = stored
+            elif codec:
+                value = block.slice(offset, length)
+            else:
+                value = view[offset:offset + length]
+                if len(value) != length:
+                    raise ValueError('Could not correctly read {} from {}.'
+                                     .format(key, self._key))
+            self._items[key] = SubItem(key, value,
+                                       is_uploaded=self._is_uploaded,
+                                       reloaded=self._reloaded)
+            self._items[key]._persisted = self._persisted
+        self._size = sum(len(item) for item in self._items.values())
+
+    def _read_item(self, rawdata: bytes, start: int = 0,
+                   type_: bytes = b'm') -> typing.Dict[str, Item]:
         """Load the sub-items from the provided raw data.
 
+        The raw data is walked once, and the values of the sub-items are
+        zero-copy slices of the raw data, so loading takes linear time.
+        Compressed values are only decompressed once a value is used.
+
         Args:
             rawdata (bytes): The raw data to loaded, formatted according to the
                 docstring on function `_write_item` of class `MultiItem`.
+            start (int): The offset in the raw data to start reading at.
+            type_ (bytes): The type of the raw data, `m`, `c` or `d`.
 
         Returns:
             list of SubItem: The list of loaded sub-items.
         """
         log = []
         items = {}
+        # get the codec or the version of the dictionary.
+        if type_ != b'm':
+            end = rawdata.index(b'\0', start)
+            if type_ == b'c':
+                self._codec = rawdata[start]
+            else:
+                self._zdict = int(rawdata[start:end])
+            start = end + 1
         # get the number of items.
-        num_items, rawdata = rawdata.split(b'\0', 1)
+        end = rawdata.index(b'\0', start)
+        num_items = int(rawdata[start:end])
+        pos = end + 1
         # for the each sub-item, get the key and length of the value
-        for _ in range(int(num_items)):
-            key, rawdata = rawdata.split(b'\0', 1)
-            length, rawdata = rawdata.split(b'\0', 1)
-            key = str(key, 'utf8')
-            length = int(length)
-            log.append((key, length))
+        for _ in range(num_items):
+            end = rawdata.index(b'\0', pos)
+            key = str(rawdata[pos:end], 'utf8')
+            pos = end + 1
+            end = rawdata.index(b'\0', pos)
+            stored = length = int(rawdata[pos:end])
+            pos = end + 1
+            if type_ == b'd':
+                end = rawdata.index(b'\0', pos)
+                length = int(rawdata[pos:end])
+                pos = end + 1
+            log.append((key, stored, length))
         # using the length of the sub-item, load the values from remaining raw
         # data.
-        for key, length in log:
-            value, rawdata = rawdata[:length], rawdata[length:]
+        view = memoryview(rawdata)
+        values_start = pos
+        if type_ == b'c':
+            block = CompressedBlock(self._codec, view[pos:],
+                                    sum(length for _, _, length in log))
+        for key, stored, length in log:
+            if type_ == b'c':
+                # the values are one block, so slice the decompressed block
+                value = block.slice(pos - values_start, length)
+            elif type_ == b'd':
+                data = view[pos:pos + stored]
+                if len(data) != stored:
+                    raise ValueError('Could not correctly read {} from {}.'
+                                     .format(key, self._key))
+                value = DictionarySlice(self._zdict, data, length)
+            else:
+                value = view[pos:pos + length]
             if len(value) != length:
                 raise ValueError('Could not correctly read {} from {}.'
                                  .format(key, self._key))
+            pos += stored
             items[key] = SubItem(key, value, is_uploaded=self._is_uploaded,
                                  reloaded=self._reloaded)
-        # check if no raw data is left over.
-        if len(rawdata) > 0:
+            items[key]._persisted = self._persisted
+        # check if no raw data is left over, the compressed block is checked
+        # once decompressed.
+        if type_ != b'c' and pos < len(rawdata):
             raise ValueError('Multi item has left over raw data.')
         return items
 
-    def _write_item(self) -> bytes:
+    def _write_header(self, items: typing.List[typing.Tuple[str, Item]],
+                      codec: int = None, zdict: int = None,
+                      stored: typing.Dict[str, int] = None) -> bytes:
+        """Dump the part of the multi-item before the values.
+
+        Args:
+            items (list of (str, SubItem)): The sub-items in order.
+            codec (int): The codec the values are compressed with, if any.
+            zdict (int): The version of the dictionary the values are
+                compressed with, if any.
+            stored (dict of str to int): The lengths of the values compressed
+                with the dictionary, by key of the sub-item.
+
+        Returns:
+            bytes: The dumped header, see `_write_item`.
+        """
+        if codec is not None:
+            parts = [b'c', bytes(self._key, 'utf8'), bytes([codec])]
+        elif zdict is not None:
+            parts = [b'd', bytes(self._key, 'utf8'), bytes(str(zdict), 'utf8')]
+        else:
+            parts = [b'm', bytes(self._key, 'utf8')]
+        parts.append(bytes(str(len(items)), 'utf8'))
+        for key, item in items:
+            parts.append(bytes(key, 'utf8'))
+            if stored is not None:
+                parts.append(bytes(str(stored[key]), 'utf8'))
+            parts.append(bytes(str(len(item)), 'utf8'))
+        parts.append(b'')
+        return b'\0'.join(parts)
+
+    def _write_item(self) -> bytearray:
         """Dump the multi-item to a correct representation for uploading.
 
-        The data is formatted as follows. The first set of variables in bytes
-        are concatenated by a NULL byte. These are
+        With `FORMAT_VERSION` 2, the data is formatted as described in
+        `kvstore.format`, with the compression below. Else the data is
+        formatted as follows. The first set of variables in bytes are
+        concatenated by a NULL byte. These are
          - `m`
          - key of multi-item
          - number of sub-items
@@ -321,29 +648,52 @@ class MultiItem(ItemBase):
         byte, since the value itself could contain a NULL byte, and thus NULL
         cannot be used as a delimiter.
 
+        If compression is configured, the type is `c` instead of `m`, the
+        number of sub-items is preceded by the byte of the codec and a NULL
+        byte, and the values are compressed together, see `kvstore.codec`.
+
+        If compression with a dictionary is configured and a dictionary was
+        trained, the type is `d`, the number of sub-items is preceded by the
+        version of the dictionary, and each value is compressed on its own,
+        see `kvstore.zdict`. The length of each compressed value precedes the
+        length of the value itself.
+
+        The size of the data is computed first, so the data is written into a
+        single buffer without reallocating.
+
         Returns:
-            bytes: The dumped data of the multi-item.
+            bytearray: The dumped data of the multi-item.
         """
         if hasattr(self, '_data') and self._data is not None:
             return self._data
-        # add general data about the multi-item
-        data = b'm\0'
-        data += bytes(self._key, 'utf8')
-        data += b'\0'
-        data += bytes(str(len(self._items)), 'utf8')
-        data += b'\0'
         # list all sub-items from dictionary to ensure equal order upon reuse
         items = list(self._items.items())
-        # for each sub-item, add the key and length of the value
-        for key, item in items:
-            data += bytes(item.key, 'utf8')
-            data += b'\0'
-            data += bytes(str(len(item)), 'utf8')
-            data += b'\0'
-        # for each sub-item, add the value itself.
-        for _, item in items:
-            data += item.value
-        self._data = data
+        values = [item.value for _, item in items]
+        self._reset_data()
+        if config.COMPRESSION == 'zdict':
+            dictionary = current_dictionary()
+            if dictionary is not None:
+                self._zdict, zdict = dictionary
+                values = [compress_value(zdict, value) for value in values]
+                self._stored = {key: len(value)
+                                for (key, _), value in zip(items, values)}
+        elif config.COMPRESSION is not None:
+            data = _fill_buffer(b'', values)
+            self._codec = choose_codec(config.COMPRESSION, data,
+                                       config.COMPRESSION_MIN_SAVING)
+            if self._codec is not None:
+                values = [compress(self._codec, data)]
+        self._format = config.FORMAT_VERSION
+        if self._format >= 2:
+            codec = self._codec or \
+                (ZDICT_CODEC if self._zdict is not None else 0)
+            self._data = write_object(KIND_MULTI, self._key,
+                                      self._entries(items), values, codec,
+                                      self._zdict or 0)
+            return self._data
+        header = self._write_header(items, self._codec, self._zdict,
+                                    self._stored)
+        self._data = _fill_buffer(header, values)
         return self._data
 
     def __len__(self) -> int:
@@ -351,12 +701,41 @@ class MultiItem(ItemBase):
         return len(self._items)
 
 
+def _fill_buffer(header: bytes, values: typing.List[bytes]) -> bytearray:
+    """Write a header followed by values into one preallocated buffer.
+
+    Note:
+        This is a private function and should not be used.
+
+    Args:
+        header (bytes): The data to start the buffer with.
+        values (list of bytes): The values to write after the header.
+
+    Returns:
+        bytearray: The buffer with the header and values.
+    """
+    size = len(header)
+    for value in values:
+        size += len(value)
+    data = bytearray(size)
+    view = memoryview(data)
+    view[:len(header)] = header
+    pos = len(header)
+    for value in values:
+        view[pos:pos + len(value)] = value
+        pos += len(value)
+    view.release()
+    return data
+
+
 def load_data(data: bytes, is_uploaded: bool = True,
               reloaded: bool = False) -> typing.Union[Item, MultiItem]:
     """Load raw data as a regular item or multi-item.
 
-    If the data starts with a `s`, this is a regular item, and if it starts with
-    an `m`, it is a multi-item.
+    Objects of format version 2 are recognized by their header, see
+    `kvstore.format`. Otherwise, if the data starts with a `s`, this is a
+    regular item, and if it starts with an `m`, it is a multi-item, or with a
+    `c` or `d` a multi-item with compressed values.
 
     Args:
         data (bytes): The raw data to be loaded.
@@ -368,15 +747,43 @@ def load_data(data: bytes, is_uploaded: bool = True,
     Returns:
         Item or MultiItem: The loaded item.
     """
-    type_, key, rawdata = data.split(b'\0', 2)
-    key = str(key, 'utf8')
+    if is_object(data):
+        kind, codec, zdict, key, entries, values_offset = read_object(data)
+        if kind == KIND_ITEM:
+            return Item(key, memoryview(data)[values_offset:], is_uploaded,
+                        reloaded=reloaded)
+        multi_item = MultiItem(key, is_uploaded=is_uploaded, reloaded=reloaded)
+        multi_item._load_object(data, codec, zdict, entries, values_offset)
+        return multi_item
+    type_end = data.index(b'\0')
+    key_end = data.index(b'\0', type_end + 1)
+    type_ = data[:type_end]
+    key = str(data[type_end + 1:key_end], 'utf8')
     if type_ == b's':
-        return Item(key, rawdata, is_uploaded, reloaded=reloaded)
-    elif type_ == b'm':
-        return MultiItem(key, rawdata, is_uploaded, reloaded=reloaded)
+        return Item(key, data[key_end + 1:], is_uploaded, reloaded=reloaded)
+    elif type_ in (b'm', b'c', b'd'):
+        return MultiItem(key, data, is_uploaded, reloaded=reloaded,
+                         start=key_end + 1, type_=bytes(type_))
     raise ValueError('Unknown item type.')
 
 
+def load_sub_data(key: str, value: bytes, zdict: int = None) -> SubItem:
+    """Load the downloaded value of a single stored sub-item.
+
+    Args:
+        key (str): The key of the sub-item.
+        value (bytes): The value of the sub-item.
+        zdict (int): The version of the dictionary the value is compressed
+            with, if any.
+
+    Returns:
+        SubItem: The loaded sub-item.
+    """
+    if zdict is not None:
+        value = decompress_value(zdict, value)
+    return SubItem(key, value, is_uploaded=True, reloaded=True)
+
+
 def new_multi_item() -> MultiItem:
     """Create a new multi-item.
 
@@ -396,6 +803,75 @@ def new_multi_item() -> MultiItem:
     return MultiItem(key)
 
 
+def seal_multi_item() -> typing.Optional[MultiItem]:
+    """Swap the current multi-item for a new one and queue it for uploading.
+
+    The watcher, or whoever stores the multi-items, takes the sealed
+    multi-items from `SEAL_QUEUE` and uploads them.
+
+    Returns:
+        MultiItem or None: The sealed multi-item, or None if it had no items.
+    """
+    with SEAL_LOCK:
+        multi_item = config.CURRENT_MULTI_ITEM
+        config.CURRENT_MULTI_ITEM = new_multi_item()
+        if multi_item is None or len(multi_item) == 0:
+            return None
+        SEAL_QUEUE.put(multi_item)
+    return multi_item
+
+
+def check_key(key: str, overwrite: bool) -> bool:
+    """Check if a key-value pair can be appended to a multi-item.
+
+    Args:
+        key (str): The key.
+        overwrite (bool): Allow the key to exist already.
+
+    Returns:
+        bool: True if the key exists already.
+
+    Raises:
+        KeyError: If the key exists and `overwrite` is False.
+        ValueError: If the key exists and is not a sub-item.
+    """
+    exists = has_key(key)
+    if exists and not overwrite:
+        raise KeyError('Key already exists.')
+    if exists and part_of(key) is None:
+        raise ValueError('Only sub-items can be overwritten.')
+    return exists
+
+
+def append_items(pairs: typing.Iterable[typing.Tuple[str, bytes]],
+                 overwrite: bool = False) -> typing.List[Item]:
+    """Append a batch of key-value pairs to the current multi-item.
+
+    All keys are checked before any pair is appended, so a batch with an
+    invalid key appends nothing. The batch is appended under a single lock.
+    Multi-items are sealed as soon as they are full, and the rest of the batch
+    is appended to the next multi-item.
+
+    Args:
+        pairs (iterable of (str, bytes)): The keys and values.
+        overwrite (bool): Allow keys to exist already, see `kvstore.put`.
+
+    Returns:
+        list of SubItem: The created sub-items.
+    """
+    subs = []
+    with SEAL_LOCK:
+        pairs = [(key, value, check_key(key, overwrite))
+                 for key, value in pairs]
+        start = 0
+        while start < len(pairs):
+            multi_item = config.CURRENT_MULTI_ITEM
+            if multi_item is None:
+                multi_item = config.CURRENT_MULTI_ITEM = new_multi_item()
+            start = multi_item._append_many(pairs, start, subs)
+    return subs
+
+
 def new_item(key: str, value: bytes) -> Item:
     """Create a new regular item.
 
@@ -444,15 +920,33 @@ def load_filename(key: str):
     return create_filename(key)
 
 
-def download_missing():
+def _fetch_item(filename: str) -> typing.Union[Item, MultiItem]:
+    """Download and load a stored item.
+
+    Note:
+        This is a private function and should not be used.
+    """
+    return load_data(download_file(filename), is_uploaded=True)
+
+
+def download_missing(workers: int = None) -> float:
     """Download the stored items that are not in the database.
 
     These items are found using their numbers. If the numbers are not yet in the
-    database, the data for the items is loaded, and the items themselves are
-    added to both the reference table and the index database.
+    database, the data for the items is downloaded and loaded concurrently, and
+    the items themselves are added to both the reference table and the index
+    database in order of their number.
+
+    Args:
+        workers (int): The maximum number of concurrent downloads. Default is
+            `RECOVERY_WORKERS` of the configuration.
+
+    Returns:
+        float: The time the recovery took in seconds.
     """
+    start = time.monotonic()
+    missing = []
     for filename in list_files():
-        print(f'download_missing: filename={filename}')
         if '_' not in filename:
             continue
         num = filename.split('_', 1)[0]
@@ -461,9 +955,98 @@ def download_missing():
         num = int(num)
         if num_exists(num):
             continue
-        print(f'download_missing: num={num}')
-        rawdata = download_file(filename)
-        item = load_data(rawdata, is_uploaded=True)
-        add_multi_item(item)
-        numerate_key(item.key, num)
+        missing.append((num, filename))
+    missing.sort()
+    if missing:
+        workers = workers or config.RECOVERY_WORKERS
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            items = executor.map(_fetch_item, [f for _, f in missing])
+            for (num, _), item in zip(missing, items):
+                if hasattr(item, 'items'):
+                    add_multi_item(item)
+                else:
+                    add_item(item)
+                numerate_key(item.key, num)
+                journal_item(item)
+    duration = time.monotonic() - start
+    print(f'download_missing: recovered {len(missing)} items in {duration:.3f} sec')
+    return duration
+
+
+def rewrite_multi_items(keys: typing.List[str],
+                        limiter=None) -> typing.List[str]:
+    """Rewrite stored multi-items into one multi-item with their live sub-items.
+
+    The sub-items still part of the multi-items according to the index are
+    written to a new multi-item, which is uploaded under a new number. Then the
+    index is switched over to the new multi-item at once. The old stored
+    multi-items are not deleted, since the switch is only persisted with the
+    next journal delta.
 
+    Args:
+        keys (list of str): The keys of the stored multi-items to rewrite.
+        limiter (RateLimiter): Limits the bytes downloaded and uploaded.
+            Default is no limit.
+
+    Returns:
+        list of str: The filenames of the old multi-items, to be deleted once
+            the journal is stored.
+    """
+    filenames = [load_filename(key) for key in keys]
+    live = []
+    for key, filename in zip(keys, filenames):
+        data = download_file(filename)
+        if limiter is not None:
+            limiter.acquire(len(data))
+        old = load_data(data, reloaded=True)
+        live += [sub for sub in old.items if stored_part_of(sub.key) == key]
+    if not live:
+        replace_multi_items(keys, None)
+        return filenames
+    multi_item = new_multi_item()
+    for sub in live:
+        # the sub-items are already registered, so they are added directly
+        item = SubItem(sub.key, sub.value, is_uploaded=True, reloaded=True)
+        item._persisted = multi_item._persisted
+        multi_item._items[sub.key] = item
+        multi_item._size += len(item)
+    reserve_num(multi_item.key)
+    try:
+        data = multi_item._write_item()
+        if limiter is not None:
+            limiter.acquire(len(data))
+        upload_file(create_filename(multi_item.key), data)
+    except Exception:
+        release_num(multi_item.key)
+        raise
+    multi_item._is_uploaded = True
+    replace_multi_items(keys, multi_item)
+    return filenames
+
+
+def replay_log() -> int:
+    """Upload the key-value pairs left behind in the write-ahead log.
+
+    The segments of multi-items that were not persisted before the process
+    stopped are replayed in order, each into a new multi-item which is uploaded
+    right away. Keys that are already in the database are overwritten, since
+    the version in the log is the newest one.
+
+    Returns:
+        int: The number of replayed key-value pairs.
+    """
+    log = write_ahead_log()
+    if log is None:
+        return 0
+    count = 0
+    for filename, _ in log.segments():
+        multi_item = new_multi_item()
+        for key, value in log.read(filename):
+            multi_item.append_key_value(key, value, overwrite=True)
+        if len(multi_item) > 0:
+            multi_item.upload()
+            count += len(multi_item)
+        log.delete(filename)
+    if count:
+        print(f'replay_log: replayed {count} items')
+    return count
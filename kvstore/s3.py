@@ -6,6 +6,7 @@ import boto3
 import botocore.client
 import botocore.exceptions
 
+from kvstore.backend import Backend
 from kvstore.exceptions import S3FileNotFoundError
 
 # We have removed all the sensitive information from our code, 
@@ -40,21 +41,22 @@ def _get_bucket():
     """
     return _get_resource().Bucket(BUCKET_NAME)
 
-S3_BUCKET = _get_bucket()
 
-
-def upload_file(filename: str, data: bytes, bucket=S3_BUCKET, save: bool = True):
+def upload_file(filename: str, data: bytes, bucket=None, save: bool = True):
     """Upload a file to the a bucket.
 
     Args:
         filename (str): The filename to upload under.
-        data (bytes): The content of the file.
+        data (bytes or bytearray): The content of the file.
         bucket: The bucket to upload to. This is a default bucket.
     """
-    return bucket.upload_fileobj(io.BytesIO(data), filename)
+    bucket = bucket or _get_bucket()
+    # bytes and bytearray are sent as the body directly, without copying them
+    # into a file object first.
+    return bucket.put_object(Key=filename, Body=data)
 
 
-def delete_file(filename: str, bucket=S3_BUCKET, saved: bool = True) -> bool:
+def delete_file(filename: str, bucket=None, saved: bool = True) -> bool:
     """Delete a file from a bucket.
 
     Args:
@@ -64,6 +66,7 @@ def delete_file(filename: str, bucket=S3_BUCKET, saved: bool = True) -> bool:
     Returns:
         bool: True if deletion was succesful.
     """
+    bucket = bucket or _get_bucket()
     response = bucket.delete_objects(Delete={'Objects': [{'Key': filename}]})
     response = response['Deleted']
     if len(response) == 0 or response[0]['Key'] != filename:
@@ -71,7 +74,26 @@ def delete_file(filename: str, bucket=S3_BUCKET, saved: bool = True) -> bool:
     return True
 
 
-def download_file(filename: str, bucket=S3_BUCKET) -> bytes:
+def delete_files(filenames: typing.List[str], bucket=None) -> bool:
+    """Delete files from a bucket, up to 1000 files per request.
+
+    Args:
+        filenames (list of str): The filenames to delete.
+        bucket: The bucket to use. This is a default bucket.
+
+    Returns:
+        bool: True if deletion was succesful.
+    """
+    bucket = bucket or _get_bucket()
+    for i in range(0, len(filenames), 1000):
+        objects = [{'Key': filename} for filename in filenames[i:i + 1000]]
+        response = bucket.delete_objects(Delete={'Objects': objects})
+        if response.get('Errors'):
+            raise Exception('Could not delete files.')
+    return True
+
+
+def download_file(filename: str, bucket=None) -> bytes:
     """Download a certain file from a bucket.
 
     Args:
@@ -81,6 +103,7 @@ def download_file(filename: str, bucket=S3_BUCKET) -> bytes:
     Returns:
         bytes: The contents of the file.
     """
+    bucket = bucket or _get_bucket()
     with io.BytesIO() as f:
         try:
             bucket.download_fileobj(filename, f)
@@ -90,14 +113,76 @@ def download_file(filename: str, bucket=S3_BUCKET) -> bytes:
         return f.read()
 
 
-def list_files(bucket=S3_BUCKET) -> typing.List[str]:
+def download_range(filename: str, offset: int, length: int,
+                   bucket=None) -> bytes:
+    """Download a part of a file from a bucket with a ranged GET.
+
+    Args:
+        filename (str): The filename to download from.
+        offset (int): The offset of the first byte to download.
+        length (int): The number of bytes to download.
+        bucket: The bucket to download from. This is a default bucket.
+
+    Returns:
+        bytes: The requested part of the file.
+    """
+    if length <= 0:
+        return b''
+    bucket = bucket or _get_bucket()
+    byte_range = 'bytes={}-{}'.format(offset, offset + length - 1)
+    try:
+        response = bucket.Object(filename).get(Range=byte_range)
+    except botocore.exceptions.ClientError:
+        raise S3FileNotFoundError('File {} not found.'.format(filename))
+    return response['Body'].read()
+
+
+def list_files(bucket=None, prefix: str = '') -> typing.List[str]:
     """List the current files on S3.
 
     Args:
         bucket: The bucket to get the list from. This is a default bucket.
+        prefix (str): Only list the files starting with this prefix.
 
     Returns:
         list of str: The list of files in the bucket.
     """
+    bucket = bucket or _get_bucket()
+    if prefix:
+        return [o.key for o in bucket.objects.filter(Prefix=prefix)]
     return [o.key for o in bucket.objects.all()]
 
+
+class S3Backend(Backend):
+    """The storage backend storing all files in an AWS S3 bucket.
+
+    Args:
+        bucket: The bucket to use. Default is the bucket configured at the top
+            of this module.
+    """
+
+    def __init__(self, bucket=None):
+        self._bucket = bucket or _get_bucket()
+
+    @property
+    def name(self) -> str:
+        return 's3-' + self._bucket.name
+
+    def upload_file(self, filename: str, data: bytes):
+        return upload_file(filename, data, bucket=self._bucket)
+
+    def download_file(self, filename: str) -> bytes:
+        return download_file(filename, bucket=self._bucket)
+
+    def download_range(self, filename: str, offset: int, length: int) -> bytes:
+        return download_range(filename, offset, length, bucket=self._bucket)
+
+    def delete_file(self, filename: str) -> bool:
+        return delete_file(filename, bucket=self._bucket)
+
+    def delete_files(self, filenames: typing.List[str]) -> bool:
+        return delete_files(filenames, bucket=self._bucket)
+
+    def list_files(self, prefix: str = '') -> typing.List[str]:
+        return list_files(bucket=self._bucket, prefix=prefix)
+
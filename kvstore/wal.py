@@ -0,0 +1,218 @@
+import os
+import struct
+import threading
+import time
+import typing
+import zlib
+
+from kvstore.backend import Backend, get_backend
+from kvstore.config import config
+
+RECORD_HEADER = struct.Struct('<III')
+SEGMENT_SUFFIX = '.wal'
+
+
+class WriteAheadLog:
+    """A local log of the key-value pairs in multi-items not yet uploaded.
+
+    Each multi-item has its own segment file in the directory. Records are
+    written to the segment when appended, and made durable with `sync`. A
+    single fsync covers all records written before it, so concurrent writers
+    share the fsync calls.
+
+    A record consists of the CRC32 of the key and value, the length of the key,
+    the length of the value, all little-endian unsigned 32-bit integers,
+    followed by the key and the value.
+
+    Args:
+        directory (str): The directory to store the segments in.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._files = {}
+        self._open = set()
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._written = 0
+        self._synced = 0
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name + SEGMENT_SUFFIX)
+
+    def append(self, segment: str, key: str, value: bytes):
+        """Write a key-value pair to a segment, without syncing it.
+
+        Args:
+            segment (str): The key of the multi-item.
+            key (str): The key of the sub-item.
+            value (bytes): The value of the sub-item.
+        """
+        key = bytes(key, 'utf8')
+        crc = zlib.crc32(value, zlib.crc32(key))
+        with self._lock:
+            f = self._files.get(segment)
+            if f is None:
+                # prefix the time, such that segments are replayed in order
+                name = '{:020d}-{}'.format(time.time_ns(), segment)
+                f = self._files[segment] = open(self._path(name), 'ab')
+                self._open.add(name + SEGMENT_SUFFIX)
+            f.write(RECORD_HEADER.pack(crc, len(key), len(value)))
+            f.write(key)
+            f.write(value)
+            f.flush()
+            self._written += 1
+
+    def sync(self):
+        """Make all written records durable.
+
+        If another thread synced in the meantime, the records written before
+        are already durable and nothing is done.
+        """
+        with self._lock:
+            target = self._written
+        with self._sync_lock:
+            if self._synced >= target:
+                return None
+            with self._lock:
+                target = self._written
+                files = list(self._files.values())
+            for f in files:
+                os.fsync(f.fileno())
+            self._synced = target
+
+    def remove(self, segment: str):
+        """Remove the segment of a multi-item once it is uploaded.
+
+        Args:
+            segment (str): The key of the multi-item.
+        """
+        with self._lock:
+            f = self._files.pop(segment, None)
+            if f is not None:
+                self._open.discard(os.path.basename(f.name))
+        if f is not None:
+            # a sync may still be using the file it took before the pop
+            with self._sync_lock:
+                f.close()
+            os.remove(f.name)
+
+    def segments(self) -> typing.List[typing.Tuple[str, str]]:
+        """List the segments in the directory in order of creation.
+
+        The segments this log is still writing to are left out, so only the
+        segments left behind by an earlier process are listed.
+
+        Returns:
+            list of (str, str): The filename and multi-item key per segment.
+        """
+        with self._lock:
+            in_use = set(self._open)
+        segments = []
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith(SEGMENT_SUFFIX) or filename in in_use:
+                continue
+            name = filename[:-len(SEGMENT_SUFFIX)]
+            segments.append((filename, name.split('-', 1)[-1]))
+        return segments
+
+    def read(self, filename: str) -> typing.List[typing.Tuple[str, bytes]]:
+        """Read the records of a segment.
+
+        Reading stops at the first incomplete or corrupt record, which is the
+        record being written during a crash.
+
+        Args:
+            filename (str): The filename of the segment.
+
+        Returns:
+            list of (str, bytes): The key-value pairs in the segment.
+        """
+        with open(os.path.join(self.directory, filename), 'rb') as f:
+            data = f.read()
+        records = []
+        pos = 0
+        while pos + RECORD_HEADER.size <= len(data):
+            crc, key_length, value_length = \
+                RECORD_HEADER.unpack_from(data, pos)
+            pos += RECORD_HEADER.size
+            key = data[pos:pos + key_length]
+            value = data[pos + key_length:pos + key_length + value_length]
+            if len(key) != key_length or len(value) != value_length or \
+                    zlib.crc32(value, zlib.crc32(key)) != crc:
+                break
+            pos += key_length + value_length
+            records.append((str(key, 'utf8'), value))
+        return records
+
+    def delete(self, filename: str):
+        """Delete a segment that was replayed.
+
+        Args:
+            filename (str): The filename of the segment.
+        """
+        os.remove(os.path.join(self.directory, filename))
+
+
+class Log:
+    """Stores the reference to the write-ahead log in use."""
+    LOG = None
+
+
+def log_directory(backend: Backend = None) -> typing.Optional[str]:
+    """Get the directory of the write-ahead log for a storage backend.
+
+    Every backend has its own directory within `WAL_DIRECTORY`, so the pairs
+    logged for one bucket are never replayed into another one.
+
+    Args:
+        backend (Backend): The storage backend. Default is the current
+            backend.
+
+    Returns:
+        str or None: The directory, or None if `WAL_DIRECTORY` is not set or
+            the backend has no name, see `Backend.name`.
+    """
+    if not config.WAL_DIRECTORY:
+        return None
+    name = (backend or get_backend()).name
+    if name is None:
+        return None
+    return os.path.join(config.WAL_DIRECTORY, name)
+
+
+def write_ahead_log() -> typing.Optional[WriteAheadLog]:
+    """Get the write-ahead log of the current backend.
+
+    Returns:
+        WriteAheadLog or None: The log, or None if no log is kept, see
+            `log_directory`.
+    """
+    directory = log_directory()
+    if directory is None:
+        return None
+    if Log.LOG is None or Log.LOG.directory != directory:
+        Log.LOG = WriteAheadLog(directory)
+    return Log.LOG
+
+
+def log_item(segment: str, key: str, value: bytes):
+    """Write a key-value pair to the log, if enabled."""
+    log = write_ahead_log()
+    if log is not None:
+        log.append(segment, key, value)
+
+
+def sync_log():
+    """Make all key-value pairs written to the log durable, if enabled."""
+    log = write_ahead_log()
+    if log is not None:
+        log.sync()
+
+
+def remove_log(segment: str):
+    """Remove the segment of an uploaded multi-item, if enabled."""
+    log = write_ahead_log()
+    if log is not None:
+        log.remove(segment)
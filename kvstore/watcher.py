@@ -1,67 +1,115 @@
+import queue
 import threading
 import time
 
+from kvstore.compaction import RateLimiter, compact, merge
 from kvstore.config import config
-from kvstore.database import store_database
-from kvstore.item import new_multi_item
+from kvstore.database import store_changes
+from kvstore.item import SEAL_QUEUE, SEAL_LOCK, seal_multi_item
+
+
+def upload_multi_item(multi_item):
+    """Upload a multi-item taken from the seal queue.
+
+    Args:
+        multi_item (MultiItem or None): The sealed multi-item, or None for an
+            entry that only wakes up the watcher.
+    """
+    try:
+        if multi_item is not None:
+            multi_item.upload()
+    finally:
+        SEAL_QUEUE.task_done()
 
 
 def swap_multi_item():
-    """Swap a multi-item for a new one and upload the 'old' multi-item."""
+    """Swap a multi-item for a new one and upload the 'old' multi-item.
+
+    Any other sealed multi-items are uploaded as well, and this function
+    returns once all sealed multi-items are uploaded.
+    """
     print('storing multi item')
-    multi_item = config.CURRENT_MULTI_ITEM
-    config.CURRENT_MULTI_ITEM = new_multi_item()
-    if multi_item is not None:
-        multi_item.upload()
+    seal_multi_item()
+    while True:
+        try:
+            multi_item = SEAL_QUEUE.get_nowait()
+        except queue.Empty:
+            break
+        upload_multi_item(multi_item)
+    SEAL_QUEUE.join()
 
 
 def _watch_database():
     """Trigger storing the database.
 
     Using the interval in the configuration, check periodically if it is time
-    to store the current database, overwriting the old stored database.
+    to upload the changes to the database as a journal delta. Once enough
+    deltas are stored, the current database is stored as a checkpoint,
+    overwriting the old stored database. Intervals without changes are
+    skipped, see `store_changes`.
     """
     last_time_local = time.time()
     last_time_online = last_time_local
+    changes = None
     while True:
         #print('check database')
         current_time = time.time()
-        if current_time - last_time_online > config.DATABASE_DUMP_INTERVAL_ONLINE:
-            print(current_time - last_time_online, 'time has passed')
-            store_database(local=None)
+        if current_time - last_time_online >= config.DATABASE_DUMP_INTERVAL_ONLINE:
+            changes = store_changes(changes)
             last_time_online = current_time
         #if current_time - last_time_local > config.DATABASE_DUMP_INTERVAL_OFFLINE:
         #    store_database()
         #    last_time_local = current_time
-        time.sleep(1)
+        # sleep until the next interval, so writers waiting for their items to
+        # be stored do not wait longer than needed.
+        elapsed = time.time() - last_time_online
+        time.sleep(min(max(config.DATABASE_DUMP_INTERVAL_ONLINE - elapsed, 0.01), 1))
 
 
 def _watch_multi_item():
-    """Trigger the creation and swapping of new multi-items.
+    """Upload sealed multi-items.
 
-    Using the maximum size of a multi-item, this function periodically checks if
-    the multi-item is large enough to be swapped for a new multi-item, and be
-    uploaded.
+    A multi-item is sealed and queued as soon as it is full according to the
+    seal policy, so the watcher sleeps until a sealed multi-item is queued and
+    uploads it right away. If the policy has an age limit, the watcher wakes up
+    in time to seal the current multi-item once it gets too old.
     """
-    while config.CURRENT_MULTI_ITEM is None:
-        time.sleep(0.1)
     while True:
-        #print('check multi item', len(config.CURRENT_MULTI_ITEM))
-        if len(config.CURRENT_MULTI_ITEM) >= config.MAX_MULTI_ITEM_SIZE:
-            #print('multi item size', len(config.CURRENT_MULTI_ITEM))
-            swap_multi_item()
-        time.sleep(1)
+        timeout = config.SEAL_POLICY.remaining(config.CURRENT_MULTI_ITEM)
+        try:
+            multi_item = SEAL_QUEUE.get(timeout=timeout)
+        except queue.Empty:
+            with SEAL_LOCK:
+                if config.SEAL_POLICY.is_expired(config.CURRENT_MULTI_ITEM):
+                    seal_multi_item()
+            continue
+        upload_multi_item(multi_item)
+
+
+def _watch_compaction():
+    """Periodically compact and merge the stored multi-items.
+
+    The limiter is shared by all passes, so the compaction I/O stays within
+    the configured rate.
+    """
+    limiter = RateLimiter(config.COMPACTION_RATE)
+    while config.COMPACTION_INTERVAL:
+        time.sleep(config.COMPACTION_INTERVAL)
+        compact(limiter=limiter)
+        merge(limiter=limiter)
 
 
 def watcher():
     """Initiate the watchers.
 
     Returns:
-        (Thread, Thread): The threads for the two created watchers.
+        (Thread, Thread, Thread): The threads for the three created watchers.
     """
     thread1 = threading.Thread(target=_watch_database, daemon=True)
     thread2 = threading.Thread(target=_watch_multi_item, daemon=True)
+    thread3 = threading.Thread(target=_watch_compaction, daemon=True)
     thread1.start()
     thread2.start()
-    return thread1, thread2
+    thread3.start()
+    return thread1, thread2, thread3
 
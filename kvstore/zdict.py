@@ -0,0 +1,216 @@
+"""Compression of single values with a trained preset dictionary.
+
+Small values compress poorly on their own, since there is no earlier data to
+refer back to. A preset dictionary of substrings common in the stored values
+gives zlib that data up front, so each value can be compressed on its own and
+still be downloaded on its own.
+"""
+import collections
+import random
+import threading
+import typing
+import zlib
+
+from kvstore.backend import download_file, upload_file, list_files
+from kvstore.config import config
+from kvstore.database import database, get_item, ItemType
+
+S3_ZDICT_PREFIX = 'kvstore_zdict_'
+"""The maximum size of a dictionary, the window size of zlib."""
+ZDICT_SIZE = 2 ** 15
+"""The length of the substrings counted when training a dictionary."""
+NGRAM = 8
+
+
+class Dictionaries:
+    """Stores the version of the dictionary in use and the loaded dictionaries."""
+    CURRENT = None
+    LOADED = {}
+    LOCK = threading.Lock()
+
+
+def zdict_filename(version: int) -> str:
+    """Create the filename for a version of the dictionary.
+
+    Args:
+        version (int): The version of the dictionary.
+
+    Returns:
+        str: The filename for the dictionary.
+    """
+    return '{}{:010d}'.format(S3_ZDICT_PREFIX, version)
+
+
+def _list_dictionaries() -> typing.List[int]:
+    """List the versions of all stored dictionaries in order.
+
+    Note:
+        This is a private function and should not be used.
+    """
+    versions = []
+    for filename in list_files(S3_ZDICT_PREFIX):
+        version = filename[len(S3_ZDICT_PREFIX):]
+        if version.isnumeric():
+            versions.append(int(version))
+    return sorted(versions)
+
+
+def load_dictionaries():
+    """Use the latest stored dictionary for new multi-items."""
+    versions = _list_dictionaries()
+    with Dictionaries.LOCK:
+        Dictionaries.CURRENT = versions[-1] if versions else None
+        Dictionaries.LOADED = {}
+
+
+def get_dictionary(version: int) -> bytes:
+    """Get a version of the dictionary, downloading it the first time.
+
+    Args:
+        version (int): The version of the dictionary.
+
+    Returns:
+        bytes: The dictionary.
+    """
+    zdict = Dictionaries.LOADED.get(version)
+    if zdict is None:
+        zdict = download_file(zdict_filename(version))
+        with Dictionaries.LOCK:
+            Dictionaries.LOADED[version] = zdict
+    return zdict
+
+
+def current_dictionary() -> typing.Optional[typing.Tuple[int, bytes]]:
+    """Get the dictionary to compress new multi-items with.
+
+    Returns:
+        (int, bytes) or None: The version and the dictionary, or None if no
+            dictionary was trained yet.
+    """
+    version = Dictionaries.CURRENT
+    if version is None:
+        return None
+    return version, get_dictionary(version)
+
+
+def train(samples: typing.List[bytes], size: int = ZDICT_SIZE) -> bytes:
+    """Train a dictionary from sample values.
+
+    The substrings occurring most often in the samples are put in the
+    dictionary. The most common substrings are put at the end, since zlib
+    encodes references to recent data in fewer bits.
+
+    Args:
+        samples (list of bytes): The sample values.
+        size (int): The maximum size of the dictionary.
+
+    Returns:
+        bytes: The dictionary.
+    """
+    counts = collections.Counter()
+    for sample in samples:
+        sample = bytes(sample)
+        for i in range(len(sample) - NGRAM + 1):
+            counts[sample[i:i + NGRAM]] += 1
+    ngrams = []
+    for ngram, count in counts.most_common(size // NGRAM):
+        if count < 2:
+            break
+        ngrams.append(ngram)
+    return b''.join(reversed(ngrams))
+
+
+def store_dictionary(zdict: bytes) -> int:
+    """Store a dictionary as the next version and use it for new multi-items.
+
+    Multi-items compressed with older versions refer to their own version, so
+    stored dictionaries are never overwritten.
+
+    Args:
+        zdict (bytes): The dictionary.
+
+    Returns:
+        int: The version of the stored dictionary.
+    """
+    versions = _list_dictionaries()
+    version = versions[-1] + 1 if versions else 1
+    upload_file(zdict_filename(version), zdict)
+    with Dictionaries.LOCK:
+        Dictionaries.LOADED[version] = zdict
+        Dictionaries.CURRENT = version
+    return version
+
+
+def train_dictionary(samples: int = None) -> typing.Optional[int]:
+    """Train a dictionary from a random sample of the stored values.
+
+    Args:
+        samples (int): The number of values to sample. Default is
+            `ZDICT_SAMPLES` of the configuration.
+
+    Returns:
+        int or None: The version of the stored dictionary, or None if there
+            are no values to train on.
+    """
+    samples = samples or config.ZDICT_SAMPLES
+    keys = [key for key, item_data in list(database()['items'].items())
+            if item_data['type'] == ItemType.SUB]
+    keys = random.sample(keys, min(samples, len(keys)))
+    zdict = train([get_item(key).value for key in keys])
+    if not zdict:
+        return None
+    return store_dictionary(zdict)
+
+
+def compress_value(zdict: bytes, value: bytes) -> bytes:
+    """Compress a single value with a dictionary.
+
+    Raw deflate is used, so no header and checksum is added to every value.
+
+    Args:
+        zdict (bytes): The dictionary.
+        value (bytes): The value to compress.
+
+    Returns:
+        bytes: The compressed value.
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=zdict)
+    return compressor.compress(value) + compressor.flush()
+
+
+def decompress_value(version: int, data: bytes) -> bytes:
+    """Decompress a value compressed with `compress_value`.
+
+    Args:
+        version (int): The version of the dictionary.
+        data (bytes): The compressed value.
+
+    Returns:
+        bytes: The value.
+    """
+    decompressor = zlib.decompressobj(-15, zdict=get_dictionary(version))
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+class DictionarySlice:
+    """A value compressed with a dictionary within the raw data of an item.
+
+    Like a memoryview, the length of the value is known without decompressing,
+    and the value itself is only produced by `tobytes`.
+    """
+
+    def __init__(self, version: int, data: bytes, length: int):
+        self._version = version
+        self._data = data
+        self._length = length
+
+    def tobytes(self) -> bytes:
+        """Decompress and return the value."""
+        value = decompress_value(self._version, self._data)
+        if len(value) != self._length:
+            raise ValueError('Decompressed value has length {} instead of {}.'
+                             .format(len(value), self._length))
+        return value
+
+    def __len__(self) -> int:
+        return self._length
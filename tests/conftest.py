@@ -0,0 +1,23 @@
+import queue
+
+import pytest
+
+from kvstore.config import config
+from kvstore.item import SEAL_QUEUE
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch, tmp_path):
+    """Reset the global state of the store for every test."""
+    monkeypatch.setattr(config, 'WAL_DIRECTORY', str(tmp_path / 'wal'))
+    monkeypatch.setattr(config, 'CURRENT_MULTI_ITEM', None)
+    monkeypatch.setattr(config, 'MAX_MULTI_ITEM_AGE', 0)
+    monkeypatch.setattr(config, 'COMPRESSION', None)
+    monkeypatch.setattr(config, 'SEAL_POLICY', config.SEAL_POLICY)
+    yield
+    while True:
+        try:
+            SEAL_QUEUE.get_nowait()
+        except queue.Empty:
+            break
+        SEAL_QUEUE.task_done()
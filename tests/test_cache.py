@@ -0,0 +1,65 @@
+import os
+
+from kvstore import get_value, initialize, put_many, store_multi_item
+from kvstore.backend import MemoryBackend
+from kvstore.cache import Disk, DiskCache, disk_cache
+from kvstore.config import config
+from kvstore.database import references
+
+VALUE = b'v' * 10
+
+
+def fill(count):
+    put_many({'key-{}'.format(x): VALUE for x in range(count)})
+    store_multi_item()
+    references().clear()
+    for x in range(count):
+        assert get_value('key-{}'.format(x)).value == VALUE
+
+
+def test_reference_limits_follow_config(monkeypatch):
+    monkeypatch.setattr(config, 'REFERENCES_MAX_ENTRIES', 5)
+    initialize(backend=MemoryBackend(), watch=False)
+    fill(30)
+    assert 0 < len(references()) <= 5
+    assert references().evictions > 0
+
+
+def test_reference_bytes_follow_config(monkeypatch):
+    monkeypatch.setattr(config, 'REFERENCES_MAX_BYTES', 100)
+    initialize(backend=MemoryBackend(), watch=False)
+    fill(30)
+    assert 0 < len(references()) * len(VALUE) <= 100
+
+
+def test_unbounded_references(monkeypatch):
+    monkeypatch.setattr(config, 'REFERENCES_MAX_ENTRIES', None)
+    monkeypatch.setattr(config, 'REFERENCES_MAX_BYTES', None)
+    initialize(backend=MemoryBackend(), watch=False)
+    fill(30)
+    assert len(references()) == 30
+
+
+def test_disk_cache_counts_a_miss_once(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, 'DISK_CACHE_DIRECTORY', str(tmp_path / 'cache'))
+    monkeypatch.setattr(Disk, 'CACHE', None)
+    initialize(backend=MemoryBackend(), watch=False)
+    put_many({'key-{}'.format(x): VALUE for x in range(3)})
+    store_multi_item()
+    references().clear()
+    # a ranged read of an object that is not cached yet
+    assert get_value('key-0').value == VALUE
+    assert (disk_cache().hits, disk_cache().misses) == (0, 1)
+    assert len(disk_cache()) == 1
+    assert get_value('key-1').value == VALUE
+    assert (disk_cache().hits, disk_cache().misses) == (1, 1)
+
+
+def test_disk_cache_keeps_no_file_open(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'), 2 ** 20)
+    cache.put('1_object', b'0123456789')
+    open_files = len(os.listdir('/proc/self/fd'))
+    cached = [cache.get('1_object') for _ in range(100)]
+    assert cached[0] == b'0123456789'
+    assert cache.read('1_object', 2, 3) == b'234'
+    assert len(os.listdir('/proc/self/fd')) == open_files
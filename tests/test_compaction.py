@@ -0,0 +1,55 @@
+from kvstore import get_value, initialize, put_many, store_multi_item
+from kvstore.backend import MemoryBackend, list_files
+from kvstore.compaction import RateLimiter, merge
+
+VALUE = b'v' * 100
+
+
+def write(prefix, count):
+    put_many({'{}-{}'.format(prefix, x): VALUE for x in range(count)})
+    store_multi_item()
+
+
+def stored_objects():
+    return {f for f in list_files() if f.split('_', 1)[0].isnumeric()}
+
+
+def test_merged_objects_are_not_rewritten():
+    initialize(backend=MemoryBackend(), watch=False)
+    write('first', 12)
+    assert merge(2 ** 20, RateLimiter(0)) == 4
+    merged = stored_objects()
+    assert len(merged) == 1
+    # nothing new is small
+    assert merge(2 ** 20, RateLimiter(0)) == 0
+    # too little new data to rewrite the merged object for
+    write('second', 3)
+    assert merge(2 ** 20, RateLimiter(0)) == 0
+    assert merged < stored_objects()
+    write('third', 6)
+    assert merge(2 ** 20, RateLimiter(0)) == 3
+    assert merged < stored_objects()
+    assert len(stored_objects()) == 2
+    # more new data than the merged object holds
+    write('fourth', 15)
+    assert merge(2 ** 20, RateLimiter(0)) == 7
+    assert len(stored_objects()) == 1
+    for prefix, count in (('first', 12), ('second', 3), ('third', 6),
+                          ('fourth', 15)):
+        for x in range(count):
+            assert get_value('{}-{}'.format(prefix, x)).value == VALUE
+
+
+def test_merge_io_is_not_quadratic():
+    initialize(backend=MemoryBackend(), watch=False)
+    limiter = RateLimiter(0)
+    transferred = []
+    limiter.acquire = transferred.append
+    rounds = 16
+    for n in range(rounds):
+        write('round{}'.format(n), 30)
+        merge(2 ** 20, limiter)
+    written = rounds * 30 * len(VALUE)
+    # rewriting everything merged so far every round transfers
+    # written * rounds / 2, every byte is only rewritten once it doubles
+    assert sum(transferred) < 2 * written * 5
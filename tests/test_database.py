@@ -0,0 +1,85 @@
+from kvstore import get_value, initialize, put, put_many, store_database, \
+    store_multi_item
+from kvstore.backend import MemoryBackend, list_files
+from kvstore.compaction import RateLimiter, merge
+from kvstore.config import config
+from kvstore.database import S3_INDEX_FILENAME, S3_INDEX_PREFIX, \
+    _download_checkpoint, delete_item, has_key, references
+from kvstore.index import ItemType
+
+VALUE = b'v' * 100
+
+
+def restart(backend):
+    config.CURRENT_MULTI_ITEM = None
+    references().clear()
+    initialize(backend=backend, watch=False)
+
+
+def test_checkpoint_keeps_superseded_version():
+    backend = MemoryBackend()
+    initialize(backend=backend, watch=False)
+    put('a', b'old')
+    store_multi_item()
+    # the new version is not uploaded before the checkpoint
+    put('a', b'new')
+    store_database()
+    restart(backend)
+    assert has_key('a')
+    assert get_value('a').value == b'old'
+
+
+def test_compaction_moves_superseded_version():
+    backend = MemoryBackend()
+    initialize(backend=backend, watch=False)
+    put('a', b'old')
+    put_many({'b-{}'.format(x): VALUE for x in range(11)})
+    store_multi_item()
+    put('a', b'new')
+    assert merge(2 ** 20, RateLimiter(0)) == 4
+    assert get_value('a').value == b'new'
+    store_database()
+    restart(backend)
+    assert get_value('a').value == b'old'
+    assert get_value('b-10').value == VALUE
+
+
+def test_replaced_shards_stay_readable():
+    backend = MemoryBackend()
+    initialize(backend=backend, watch=False)
+    put_many({'key-{}'.format(x): VALUE for x in range(100)})
+    store_multi_item()
+    store_database()
+    # a reader of this checkpoint downloads the shards once looked up
+    reader = _download_checkpoint()[0]
+    put_many({'key-{}'.format(x): b'new' for x in range(100)})
+    store_multi_item()
+    store_database()
+    for x in range(100):
+        assert reader.items['key-{}'.format(x)]['type'] == ItemType.SUB
+
+
+def test_retired_files_are_deleted_after_grace(monkeypatch):
+    monkeypatch.setattr(config, 'DATABASE_RETIRE_GRACE', 0)
+    backend = MemoryBackend()
+    initialize(backend=backend, watch=False)
+    for value in (b'first', b'second', b'third'):
+        put_many({'key-{}'.format(x): value for x in range(100)})
+        store_multi_item()
+        store_database()
+    shards = [f for f in list_files(S3_INDEX_PREFIX)
+              if f != S3_INDEX_FILENAME]
+    assert len(shards) == config.DATABASE_SHARDS
+
+
+def test_deleting_a_multi_item_keeps_newer_versions():
+    initialize(backend=MemoryBackend(), watch=False)
+    put('a', b'old')
+    put('b', b'other')
+    old = config.CURRENT_MULTI_ITEM
+    store_multi_item()
+    put('a', b'new')
+    store_multi_item()
+    delete_item(old)
+    assert not has_key('b')
+    assert get_value('a').value == b'new'
@@ -0,0 +1,117 @@
+import os
+import subprocess
+import sys
+
+from kvstore import get_value, initialize, new_item, store_database, \
+    store_journal, store_multi_item
+from kvstore.backend import LocalBackend, MemoryBackend
+from kvstore.config import config
+from kvstore.database import has_key
+from kvstore.wal import WriteAheadLog, log_directory, write_ahead_log
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the watcher threads cannot be stopped, so the scenarios running them are run
+# in a separate process.
+CONCURRENT_PUTS = '''
+import sys
+import threading
+
+from kvstore import initialize, put
+from kvstore.backend import LocalBackend
+from kvstore.config import config
+
+directory = sys.argv[1]
+config.WAL_DIRECTORY = directory + '/wal'
+config.DATABASE_DUMP_INTERVAL_ONLINE = 0.05
+config.COMPACTION_INTERVAL = 0
+initialize(backend=LocalBackend(directory + '/store'))
+errors = []
+
+
+def writer(n):
+    try:
+        for x in range(300):
+            put('key-{}-{}'.format(n, x), b'value')
+    except Exception as e:
+        errors.append(repr(e))
+
+
+threads = [threading.Thread(target=writer, args=(n,)) for n in range(8)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+print('errors:', errors)
+sys.exit(1 if errors else 0)
+'''
+
+
+def test_concurrent_puts_with_watcher(tmp_path):
+    result = subprocess.run([sys.executable, '-c', CONCURRENT_PUTS,
+                             str(tmp_path)], capture_output=True, text=True,
+                            timeout=120, cwd=ROOT)
+    assert result.returncode == 0, result.stdout[-2000:] + result.stderr[-2000:]
+
+
+def test_remove_during_sync(tmp_path):
+    log = WriteAheadLog(str(tmp_path))
+    log.append('multi', 'key', b'value')
+    log.remove('multi')
+    log.sync()
+    assert log.segments() == []
+
+
+def test_read_stops_at_torn_record(tmp_path):
+    log = WriteAheadLog(str(tmp_path))
+    log.append('multi', 'key1', b'value1')
+    log.append('multi', 'key2', b'value2')
+    log.sync()
+    path = next(tmp_path.iterdir())
+    with open(path, 'r+b') as f:
+        f.truncate(path.stat().st_size - 1)
+    other = WriteAheadLog(str(tmp_path))
+    (filename, segment), = other.segments()
+    assert segment == 'multi'
+    assert other.read(filename) == [('key1', b'value1')]
+
+
+def test_log_is_kept_per_backend(tmp_path, monkeypatch):
+    first = LocalBackend(str(tmp_path / 'first'))
+    initialize(backend=first, watch=False)
+    new_item('key', b'value')
+    assert os.listdir(log_directory(first))
+    # restart without uploading the logged pair, on another backend first
+    monkeypatch.setattr(config, 'CURRENT_MULTI_ITEM', None)
+    initialize(backend=LocalBackend(str(tmp_path / 'second')), watch=False)
+    assert not has_key('key')
+    initialize(backend=first, watch=False)
+    assert get_value('key').value == b'value'
+
+
+def test_memory_backend_keeps_no_log():
+    initialize(backend=MemoryBackend(), watch=False)
+    new_item('key', b'value')
+    assert log_directory() is None
+    assert write_ahead_log() is None
+
+
+def test_checkpoint_removes_log(tmp_path):
+    initialize(backend=LocalBackend(str(tmp_path / 'data')), watch=False)
+    new_item('key', b'value')
+    store_multi_item()
+    assert os.listdir(log_directory())
+    store_database()
+    assert not os.listdir(log_directory())
+
+
+def test_restart_keeps_unjournaled_changes(tmp_path, monkeypatch):
+    backend = LocalBackend(str(tmp_path / 'data'))
+    initialize(backend=backend, watch=False)
+    new_item('key', b'value')
+    store_multi_item()
+    monkeypatch.setattr(config, 'CURRENT_MULTI_ITEM', None)
+    initialize(backend=backend, watch=False, fetch=False)
+    assert has_key('key')
+    store_journal()
+    assert not os.listdir(log_directory())